@@ -0,0 +1,327 @@
+'''bench_pd -- benchmarks for cms_pd pivot stages
+
+Usage:
+  python bench_pd.py [ROWS]
+
+Each benchmark builds synthetic data shaped like a CMS RIF table
+(see `cms_pd._RIFTestData`), checks that the optimized code agrees with
+a straightforward reference implementation, and reports timings for both.
+'''
+
+from random import Random
+from timeit import default_timer
+from typing import Callable, Dict, Iterator, List, Optional as Opt, Tuple
+import logging
+import tracemalloc
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+import sqlalchemy as sqla
+
+from cms_pd import (
+    CMSRIFUpload, CMSVariables, CarrierClaimUpload, CodeFormat, FactBuffer, FactStats,
+    MEDPAR_Upload, MedparMapped, Vocabulary, _RIFTestData, _no_dups,
+    fmt_dx_codes, obs_stack)
+
+log = logging.getLogger(__name__)
+
+
+def medpar_shaped(rows: int, distinct: int=200,
+                  task_family: type=MEDPAR_Upload) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    '''MEDPAR_Upload- (or other) shaped data: `distinct` records repeated to `rows`.
+
+    >>> rif_data, col_info = medpar_shaped(12, distinct=5)
+    >>> len(rif_data), list(rif_data.index[-3:])
+    (12, [9, 10, 11])
+    '''
+    rif_data, col_info, _simple = _RIFTestData.build(task_family, qty=distinct)
+    for name in col_info[col_info.valtype_cd == 'D'].column_name:
+        rif_data[name] = pd.to_datetime(rif_data[name])  # as from read_sql
+    reps = -(-rows // distinct)
+    rif_data = pd.concat([rif_data] * reps, ignore_index=True)[:rows]
+    return rif_data, col_info
+
+
+def obs_stack_loop(rif_data: pd.DataFrame,
+                   rif_table_name: str, projections: pd.DataFrame,
+                   id_vars: List[str], value_vars: List[str]) -> pd.DataFrame:
+    '''Reference obs_stack: copy, stack, and append one column group at a time.
+    '''
+    assert id_vars == _no_dups(id_vars)
+    spare_digits = CMSVariables.max_cols_digits
+
+    parts = []
+    for ix, ((mod_grp, x), rif_cols) in enumerate(projections.iterrows()):
+        value_cols = list(rif_cols.dropna())
+        obs = rif_data[id_vars + value_cols].copy()
+        obs.columns = id_vars + value_vars[:len(value_cols)]
+        obs['instance_num'] = obs.index * (10 ** spare_digits) + ix
+        obs = obs.dropna(subset=value_vars[:2])
+        obs['mod_grp'] = mod_grp
+        obs['x'] = x
+        parts.append(obs)
+    return pd.concat(parts, ignore_index=True)
+
+
+def bench_obs_stack(rows: int) -> Dict[str, float]:
+    '''Time obs_stack against the one-group-at-a-time reference.
+
+    >>> sorted(bench_obs_stack(50).keys())
+    ['dx_loop', 'dx_stack', 'px_loop', 'px_stack']
+    '''
+    rif_data, col_info = medpar_shaped(rows)
+    id_vars = [col for col in MEDPAR_Upload.obs_id_vars
+               if col in MEDPAR_Upload.i2b2_map]
+    id_vars = _no_dups([MEDPAR_Upload.i2b2_map[v] for v in id_vars])
+    kinds = [
+        ('dx', MEDPAR_Upload.vrsn_cd_groups(col_info, kind='DGNS', aux='DGNS_IND'),
+         ['dgns_vrsn', 'dgns_cd', 'dgns_poa_ind']),
+        ('px', MEDPAR_Upload.vrsn_cd_groups(col_info, kind='PRCDR', aux='PRCDR_DT'),
+         ['prcdr_vrsn', 'prcdr_cd', 'prcdr_dt'])]
+
+    timings = {}
+    for kind, projections, value_vars in kinds:
+        results = {}
+        for label, f in [('loop', obs_stack_loop), ('stack', obs_stack)]:
+            results[label], timings[kind + '_' + label] = _timed(
+                lambda: f(rif_data, MEDPAR_Upload.table_name, projections,
+                          id_vars=id_vars, value_vars=value_vars))
+        _assert_same(results['loop'], results['stack'])
+    return timings
+
+
+def bench_code_format(rows: int) -> Dict[str, float]:
+    '''Time memoized diagnosis code formatting against formatting each row.
+
+    >>> sorted(bench_code_format(50).keys())
+    ['dx_each', 'dx_memo']
+    '''
+    rif_data, col_info = medpar_shaped(rows)
+    dgns_cd = pd.concat([rif_data[col] for col in col_info[col_info.dxpx == 'DGNS_CD'].column_name],
+                        ignore_index=True)
+    dgns_vrsn = pd.Series(['9'] * len(dgns_cd))
+
+    each, each_time = _timed(lambda: fmt_dx_codes(dgns_vrsn, dgns_cd))
+    memo, memo_time = _timed(lambda: pd.Series(CodeFormat(fmt_dx_codes)(dgns_vrsn, dgns_cd)))
+    assert each.astype(str).equals(memo.astype(str))
+    return dict(dx_each=each_time, dx_memo=memo_time)
+
+
+def busy_benes(bene_qty: int, stay_qty: int, day_qty: int,
+               rng: Random) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    '''Synthetic stays and patient-days for high-utilization beneficiaries.
+
+    Stays are mostly back-to-back, with the occasional long stay
+    that overlaps several others.
+
+    >>> stays, pat_day = busy_benes(2, 3, 4, Random(1))
+    >>> len(stays), len(pat_day), list(stays.columns)
+    (6, 8, ['bene_id', 'medpar_id', 'encounter_num', 'admsn_dt', 'dschrg_dt'])
+    '''
+    epoch = pd.Timestamp('2010-01-01')
+    stays = []  # type: List[Tuple[str, str, int, pd.Timestamp, pd.Timestamp]]
+    days = []  # type: List[Tuple[str, pd.Timestamp]]
+    for b in range(bene_qty):
+        bene_id = '%d' % (100000 + b)
+        admsn = 0
+        for s in range(stay_qty):
+            admsn += rng.randint(0, 10)
+            los = rng.randint(30, 90) if rng.randint(1, 20) == 1 else rng.randint(0, 8)
+            stays.append((bene_id, '%s-%d' % (bene_id, s), len(stays) + 1,
+                          epoch + pd.Timedelta(days=admsn), epoch + pd.Timedelta(days=admsn + los)))
+        days.extend((bene_id, epoch + pd.Timedelta(days=rng.randint(-30, admsn + 30)))
+                    for _ in range(day_qty))
+    stays_df = pd.DataFrame.from_records(
+        stays, columns=['bene_id', 'medpar_id', 'encounter_num', 'admsn_dt', 'dschrg_dt'])
+    pat_day = pd.DataFrame.from_records(days, columns=['bene_id', 'start_day'])
+    return stays_df.sample(frac=1, random_state=1), pat_day
+
+
+def pat_day_stays_merge(pat_day: pd.DataFrame, medpar_mapping: pd.DataFrame) -> pd.DataFrame:
+    '''Reference pat_day_stays: pair each patient-day with all stays, then filter.
+    '''
+    pat_enc = pat_day.merge(medpar_mapping, on='bene_id', how='left')
+    pat_enc = pat_enc[(pat_enc.start_day >= pat_enc.admsn_dt) &
+                      (pat_enc.start_day <= pat_enc.dschrg_dt)]
+    return pat_enc[~pat_enc.duplicated(['bene_id', 'start_day'], keep='first')]
+
+
+def bench_pat_day_stays(bene_qty: int, stay_qty: int=300, day_qty: int=2000) -> Dict[str, float]:
+    '''Time interval lookup of stays against merge-then-filter.
+
+    >>> sorted(bench_pat_day_stays(3, 20, 50).keys())
+    ['merge', 'merge_pairs', 'search']
+    '''
+    stays, pat_day = busy_benes(bene_qty, stay_qty, day_qty, Random(1))
+    pat_day = pat_day.drop_duplicates()
+    expected, merge_time = _timed(lambda: pat_day_stays_merge(pat_day, stays))
+    actual, search_time = _timed(lambda: MedparMapped.pat_day_stays(pat_day, stays))
+    _assert_same(expected, actual, key=['bene_id', 'start_day'])
+    return dict(merge=merge_time, search=search_time,
+                merge_pairs=float(len(pat_day.merge(stays[['bene_id']], on='bene_id'))))
+
+
+def observation_fact(meta: sqla.MetaData, name: str='observation_fact') -> sqla.Table:
+    '''Stand-in for i2b2 observation_fact (in sqlite, for example).
+    '''
+    C, T = sqla.Column, sqla.types
+    return sqla.Table(
+        name, meta,
+        C('encounter_num', T.Integer), C('patient_num', T.Integer),
+        C('concept_cd', T.String(50)), C('provider_id', T.String(50)),
+        C('start_date', T.DateTime), C('modifier_cd', T.String(100)),
+        C('instance_num', T.Integer), C('valtype_cd', T.String(50)),
+        C('tval_char', T.String(255)), C('nval_num', T.Numeric(18, 5)),
+        C('valueflag_cd', T.String(50)), C('quantity_num', T.Numeric(18, 5)),
+        C('units_cd', T.String(50)), C('end_date', T.DateTime),
+        C('location_cd', T.String(50)), C('confidence_num', T.Numeric(18, 5)),
+        C('update_date', T.DateTime), C('download_date', T.DateTime),
+        C('import_date', T.DateTime), C('sourcesystem_cd', T.String(50)),
+        C('upload_id', T.Integer))
+
+
+class _NoMedpar(object):
+    '''Just enough of a task to map facts to patients and patient-days.
+    '''
+    def __init__(self, task_family: type) -> None:
+        self.task_family = task_family
+
+    def with_mapping(self, obs: pd.DataFrame, pmap: pd.DataFrame,
+                     vocab: Vocabulary) -> pd.DataFrame:
+        emap = pd.DataFrame(dict(medpar_id=[], bene_id=[], encounter_num=[],
+                                 admsn_dt=pd.to_datetime([]), dschrg_dt=pd.to_datetime([])))
+        return CMSRIFUpload.with_mapping(self.task_family, obs, pmap, emap, vocab)  # type: ignore
+
+
+def check_start_date_frame(obs: pd.DataFrame,
+                           threshold: Opt[Tuple[float, logging.Logger]]=None) -> pd.DataFrame:
+    '''Reference: drop facts with null start_date, as before `FactBuffer.validate`.
+    '''
+    tot = len(obs)
+    if tot:
+        bad = obs[obs.start_date.isnull()]
+        if len(bad) > 0:
+            if threshold is None:
+                raise ValueError(bad.head())
+            val, log = threshold
+            if len(bad) * 1.0 / tot > val:
+                raise ValueError(bad.head())
+            else:
+                log.warning('ignoring %d (%f%%) records with null start_date',
+                            len(bad), 100.0 * len(bad) / tot)
+            obs = obs[~obs.start_date.isnull()]
+    return obs
+
+
+def bench_fact_buffer(rows: int) -> Dict[str, float]:
+    '''Compare peak memory of pivoting a chunk of BCARRIER_CLAIMS
+    through frames vs. through a FactBuffer, including the insert.
+    The rows inserted either way must be the same.
+
+    >>> sorted(bench_fact_buffer(50).keys())
+    ['buffer_peak', 'buffer_time', 'frame_peak', 'frame_time']
+    '''
+    T = CarrierClaimUpload
+    rif_data, col_info = medpar_shaped(rows, task_family=T)
+    plan = T.pivot_plan(col_info)
+    pmap = pd.DataFrame(dict(bene_id=rif_data.bene_id.unique()))
+    pmap['patient_num'] = range(len(pmap))
+    mapper = _NoMedpar(T)
+    admin = dict(sourcesystem_cd='ccwdata.org', upload_id=1,
+                 download_date=pd.Timestamp('2017-01-01').to_pydatetime(),
+                 import_date=pd.Timestamp('2017-01-02').to_pydatetime())
+    db = sqla.create_engine('sqlite://')  # type: ignore
+    fact_t = observation_fact(sqla.MetaData())
+    fact_t.create(db)
+
+    def via_frames() -> int:
+        vocab = Vocabulary()
+        obs = pd.concat([part for part in [
+            T.dx_data(rif_data, T.table_name, plan.dx_groups, vocab=vocab),
+            T.px_data(rif_data, T.table_name, plan.px_groups, vocab=vocab),
+            T.pivot_facts(rif_data, plan, vocab=vocab)] if part is not None])
+        mapped = mapper.with_mapping(obs, pmap, vocab)
+        out = mapped[[col.name for col in fact_t.columns if col.name in mapped.columns.values]].copy()
+        for name, value in admin.items():
+            out[name] = value
+        out = vocab.as_categories(out, Vocabulary.fact_columns)
+        out['upload_id'] = 1
+        out = check_start_date_frame(out, threshold=(0.5, log))
+        # what to_sql(chunksize=None) does: all rows in one executemany,
+        # with None for nulls; astype(object) column by column, as
+        # pandas 0.19 can't convert a frame with categoricals at once
+        names = list(out.columns)
+        values = [out[name].astype(object).values for name in names]
+        values = [np.where(pd.isnull(col), None, col) for col in values]
+        with db.begin() as conn:
+            conn.execute(fact_t.insert(), [dict(zip(names, row)) for row in zip(*values)])
+        return len(out)
+
+    def via_buffer() -> int:
+        facts = FactBuffer(Vocabulary())
+
+        def parts() -> Iterator[Opt[pd.DataFrame]]:
+            yield T.dx_data(rif_data, T.table_name, plan.dx_groups, vocab=facts.vocab)
+            yield T.px_data(rif_data, T.table_name, plan.px_groups, vocab=facts.vocab)
+            yield T.pivot_facts(rif_data, plan, vocab=facts.vocab)
+
+        for obs in parts():
+            if obs is not None:
+                facts.append(mapper.with_mapping(obs, pmap, facts.vocab))
+            del obs
+        facts.validate(FactStats(), FactBuffer.column_lengths(fact_t), threshold=(0.5, log))
+        with db.begin() as conn:
+            return facts.insert(conn, fact_t, dict(admin, upload_id=2))
+
+    timings = {}
+    for label, f in [('frame', via_frames), ('buffer', via_buffer)]:
+        tracemalloc.start()
+        _qty, timings[label + '_time'] = _timed(f)
+        timings[label + '_peak'] = float(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    def inserted(upload_id: int) -> pd.DataFrame:
+        rows = pd.read_sql(sqla.select([fact_t]).where(fact_t.c.upload_id == upload_id), db)
+        return rows.drop('upload_id', axis=1)
+    frame_rows = inserted(1)
+    _assert_same(frame_rows, inserted(2), key=list(frame_rows.columns))
+    return timings
+
+
+def _timed(thunk: Callable[[], pd.DataFrame]) -> Tuple[pd.DataFrame, float]:
+    t0 = default_timer()
+    result = thunk()
+    return result, default_timer() - t0
+
+
+def _assert_same(expected: pd.DataFrame, actual: pd.DataFrame,
+                 key: object='instance_num') -> None:
+    expected = expected.sort_values(key).reset_index(drop=True)
+    actual = actual.sort_values(key).reset_index(drop=True)[expected.columns]
+    assert expected.astype(str).equals(actual.astype(str))
+
+
+if __name__ == '__main__':
+    def _script() -> None:
+        from sys import argv
+
+        rows = int(argv[1]) if len(argv) > 1 else 100000
+        timings = bench_obs_stack(rows)
+        for kind in ['dx', 'px']:
+            loop, stack = timings[kind + '_loop'], timings[kind + '_stack']
+            print('obs_stack %s %d rows: loop %.3fs stack %.3fs (%.1fx)' % (
+                kind, rows, loop, stack, loop / stack))
+        timings = bench_code_format(rows)
+        each, memo = timings['dx_each'], timings['dx_memo']
+        print('fmt dx codes %d rows: each %.3fs memo %.3fs (%.1fx)' % (
+            rows, each, memo, each / memo))
+        bene_qty = max(1, rows // 1000)
+        timings = bench_pat_day_stays(bene_qty)
+        merge, search = timings['merge'], timings['search']
+        print('pat_day_stays %d benes x 300 stays: merge %.3fs (%d pairs) search %.3fs (%.1fx)' % (
+            bene_qty, merge, timings['merge_pairs'], search, merge / search))
+        timings = bench_fact_buffer(rows)
+        frame, buf = timings['frame_peak'], timings['buffer_peak']
+        print('bcarrier_claims facts %d rows: peak memory frames %.1fMB buffer %.1fMB (%.1fx)' % (
+            rows, frame / 1e6, buf / 1e6, frame / buf))
+    _script()
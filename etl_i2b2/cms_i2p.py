@@ -16,15 +16,16 @@ __ https://github.com/kumc-bmi/i2p-transform
 
 '''
 
+from functools import partial
 from typing import List, Tuple, cast
 
 import luigi
 import pandas as pd  # type: ignore
 
-from cms_pd import read_sql_step, obj_string
+from cms_pd import read_sql_step, obj_string, read_ahead, write_stage
 from etl_tasks import DBAccessTask, I2B2Task, SqlScriptTask, LoggedConnection, log_plan
 from eventlog import EventLogger
-from param_val import IntParam, StrParam
+from param_val import BoolParam, IntParam, StrParam
 from script_lib import Script
 from sql_syntax import Environment, Params
 
@@ -156,6 +157,8 @@ class ProceduresLoad(_HarvestRefresh):
                              description='bound enc_type mapping chunks too')
     chunksize = IntParam(default=50000, significant=False)
     parallel_degree = IntParam(default=12, significant=False)
+    # fetch the next chunk and insert the last one in threads
+    pipeline = BoolParam(default=False, significant=False)
 
     obs_q = """
         select /*+ parallel({degree}) */
@@ -194,41 +197,50 @@ class ProceduresLoad(_HarvestRefresh):
         target = '{ps}.{table}'.format(ps=self.harvest.schema, table=self.table)
         proceduresid = 0
 
-        for _, _, lo, hi in pat_groups:
-            enc_type_map = self.enc_type_group(lc, (lo, hi))
-            for obs in pd.read_sql(self.obs_q
-                                   .format(i2b2_star=self.project.star_schema, degree=self.parallel_degree),
-                                   params=dict(proc_pat=self.proc_pat, lo=lo, hi=hi),
-                                   con=lc._conn,
-                                   chunksize=self.chunksize):
-                with lc.log.step('%(event)s into %(target)s %(obs_qty)d obs',
-                                 dict(event='insert observations', target=target, obs_qty=len(obs))) as step:
-                    px = merge(px_meta, key=obs.concept_cd)
-                    obs = obs[obs.concept_cd.isin(px_meta.index)]     # ISSUE: drop facts with no px_meta
-                    enc = merge(enc_type_map, key=obs.encounter_num)  # ISSUE: obs with no visit_dimension get null.
-                    proc = pd.DataFrame(dict(
-                        patid=obs.patient_num,
-                        encounterid=obs.encounter_num,
-                        enc_type=enc.enc_type,
-                        admit_date=enc.admit_date,
-                        providerid=enc.providerid,
-                        px_date=obs.start_date,
-                        px=px.px,
-                        px_type=px.px_type,
-                        px_source='CL',
-                        raw_px=obs.instance_num,
-                        raw_px_type=obs.upload_id),
-                    )
-                    proc.index = pd.RangeIndex(proceduresid, proceduresid + len(proc))
-                    proc.index.names = ['proceduresid']
-
-                    assert not any(proc.index.duplicated())
-
-                    proc.to_sql(schema=self.harvest.schema, name=self.table,
-                                con=lc._conn, dtype=obj_string(proc), if_exists='append')
-                    step.argobj.update(dict(proc_ix_start=proceduresid, proc_qty=len(proc)))
-                    step.msg_parts.append(' proceduresid %(proc_ix_start)d + %(proc_qty)d')
-                    proceduresid += len(proc)
+        def write(proc: pd.DataFrame, writing: LoggedConnection) -> None:
+            with writing.log.step('%(event)s into %(target)s %(proc_qty)d rows',
+                                  dict(event='insert procedures', target=target, proc_qty=len(proc))):
+                proc.to_sql(schema=self.harvest.schema, name=self.table,
+                            con=writing._conn, dtype=obj_string(proc), if_exists='append')
+
+        with write_stage(self, self.pipeline, 'insert procedures', lc) as submit:
+            for _, _, lo, hi in pat_groups:
+                enc_type_map = self.enc_type_group(lc, (lo, hi))
+                chunks = pd.read_sql(self.obs_q
+                                     .format(i2b2_star=self.project.star_schema, degree=self.parallel_degree),
+                                     params=dict(proc_pat=self.proc_pat, lo=lo, hi=hi),
+                                     con=lc._conn,
+                                     chunksize=self.chunksize)
+                if self.pipeline:
+                    chunks = read_ahead(lc.log, chunks, 'select observations')
+                for obs in chunks:
+                    with lc.log.step('%(event)s into %(target)s %(obs_qty)d obs',
+                                     dict(event='insert observations', target=target, obs_qty=len(obs))) as step:
+                        px = merge(px_meta, key=obs.concept_cd)
+                        obs = obs[obs.concept_cd.isin(px_meta.index)]     # ISSUE: drop facts with no px_meta
+                        enc = merge(enc_type_map, key=obs.encounter_num)  # ISSUE: obs with no visit_dimension get null.
+                        proc = pd.DataFrame(dict(
+                            patid=obs.patient_num,
+                            encounterid=obs.encounter_num,
+                            enc_type=enc.enc_type,
+                            admit_date=enc.admit_date,
+                            providerid=enc.providerid,
+                            px_date=obs.start_date,
+                            px=px.px,
+                            px_type=px.px_type,
+                            px_source='CL',
+                            raw_px=obs.instance_num,
+                            raw_px_type=obs.upload_id),
+                        )
+                        proc.index = pd.RangeIndex(proceduresid, proceduresid + len(proc))
+                        proc.index.names = ['proceduresid']
+
+                        assert not any(proc.index.duplicated())
+
+                        submit(partial(write, proc))
+                        step.argobj.update(dict(proc_ix_start=proceduresid, proc_qty=len(proc)))
+                        step.msg_parts.append(' proceduresid %(proc_ix_start)d + %(proc_qty)d')
+                        proceduresid += len(proc)
 
     @classmethod
     def proc_code_map(cls, lc: LoggedConnection) -> pd.DataFrame:
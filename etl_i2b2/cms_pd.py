@@ -380,13 +380,21 @@ The MAXDATA_IP table has only one procedure date column::
 
 """
 
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
 from io import StringIO
-import logging
 from random import Random
+from timeit import default_timer
 from typing import (
-    Any, Iterable, Iterator, List, Dict, Optional as Opt,
-    Tuple, Type, TypeVar, cast)
+    Any, Callable, Iterable, Iterator, List, Dict, Optional as Opt,
+    Tuple, Type, TypeVar, Union, cast)
 import enum
+import logging
+import multiprocessing
+import os
+import queue
+import threading
 
 import cx_ora_fix; cx_ora_fix.patch_version()  # noqa: E702
 
@@ -395,14 +403,16 @@ import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
 import pkg_resources as pkg
 import sqlalchemy as sqla
+from sqlalchemy.engine.result import ResultProxy
 
 from cms_etl import FromCMS, DBAccessTask, BeneIdSurvey, PatientMapping, MedparMapping
+from eventlog import EventLogger
 from etl_tasks import (
     LoggedConnection, LogState,
     SqlScriptTask, ReportTask, UploadTarget, UploadTask,
     make_url, log_plan
 )
-from param_val import IntParam, StrParam
+from param_val import BoolParam, IntParam, StrParam
 from script_lib import Script
 from sql_syntax import Params
 
@@ -437,9 +447,13 @@ class _LoadTask(FromCMS, DBAccessTask):
     def _upload_target(self) -> 'UploadTarget':
         return UploadTarget(self._make_url(self.account),
                             self.project.upload_table,
-                            self.task_id, self.source,
+                            self.transform_name, self.source,
                             echo=self.echo)
 
+    @property
+    def transform_name(self) -> str:
+        return self.task_id
+
     def run(self) -> None:
         upload = self._upload_target()
         with upload.job(self,
@@ -453,77 +467,172 @@ class _LoadTask(FromCMS, DBAccessTask):
 
     def with_admin(self, detail: pd.DataFrame, upload_id: int,
                    lc: LoggedConnection, table_info: sqla.Table) -> pd.DataFrame:
-        current_time = pd.read_sql(sqla.select([sqla.func.current_timestamp()]),
-                                   lc._conn).iloc[0][0]
         out = detail[[col.name for col in table_info.columns
                       if col.name in detail.columns.values]].copy()
-        out['sourcesystem_cd'] = self.source.source_cd.replace("'", '')  # kludgy
-        out['download_date'] = self.source.download_date
-        out['upload_id'] = upload_id
-        out['import_date'] = current_time
+        for name, value in self.admin_values(upload_id, lc).items():
+            out[name] = value
         return out
 
+    def admin_values(self, upload_id: int, lc: LoggedConnection) -> Dict[str, Any]:
+        current_time = pd.read_sql(sqla.select([sqla.func.current_timestamp()]),
+                                   lc._conn).iloc[0][0]
+        return dict(sourcesystem_cd=self.source.source_cd.replace("'", ''),  # kludgy
+                    download_date=self.source.download_date,
+                    upload_id=upload_id,
+                    import_date=current_time)
+
 
 class DataLoadTask(_LoadTask):
+    # fetch the next chunk and insert the last one in threads
+    # while we pivot this one
+    pipeline = BoolParam(default=False, significant=False)
+    # side table of distinct concept_cd (with fact counts) per upload ('': none)
+    concept_table = StrParam(default='', significant=False)
+    # side table of fact statistics per upload ('': none); see FactSummaries
+    summary_table = StrParam(default='', significant=False)
+    # side table of visit rows per upload ('': none); see VisitDimForPatGroup.visit_rows
+    visit_table = StrParam(default='', significant=False)
+    enc_code_meta = 'enc_code_meta'  # from cms_visit_dimension.sql
+    # check concept_cd against the basecodes of these (comma-separated) ontology tables
+    ontology_tables = StrParam(default='', significant=False)
+    # facts with the same primary key as an earlier fact of the upload:
+    # 'drop' them, 'fail' (with examples), or '' don't check.
+    # Only keys in the same chunk are confirmed and dropped; see FactBuffer.drop_duplicate_keys
+    duplicate_keys = StrParam(default='', significant=False)
+
     def load(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int, result: Params) -> None:
         [fact_proto] = self.project.table_details(lc, ['observation_fact']).tables.values()
+        fact_table, fact_upload_id = self.fact_target(lc, upload, upload_id, fact_proto, result)
+        # Facts loaded into an earlier upload (see CMSRIFUpload.repivot) are only
+        # part of its facts; side tables by upload_id would count them twice.
+        side_tables = fact_upload_id == upload_id
+        if not side_tables:
+            lc.log.info('UP#%(upload_id)d: %(event)s: facts go into UP#%(into)d',
+                        dict(event='skip side tables', upload_id=upload_id, into=fact_upload_id))
+        bulk_rows = 0
+        stats = FactStats(date_range=(np.datetime64('1900-01-01'),
+                                      np.datetime64(self.source.download_date)))
+        lengths = FactBuffer.column_lengths(fact_table)
+        concepts = ConceptCounts()
+        summary = FactSummary()
+        visits = VisitRows(read_sql_step(
+            "select * from %s where field_name = 'ENC_TYPE'" % self.enc_code_meta, lc)
+        ) if self.visit_table and side_tables else None
+        if self.duplicate_keys not in ['', 'drop', 'fail']:
+            raise ValueError('duplicate_keys: expected drop or fail; got: %s' % self.duplicate_keys)
+        seen = SeenKeys()
+        known = KnownCodes(ontology_basecodes(lc, [
+            t.strip() for t in self.ontology_tables.split(',')])) if self.ontology_tables else None
+        vocab = None  # type: Opt[Vocabulary]
+
+        def write(facts: FactBuffer, pct_in: float, wc: LoggedConnection) -> None:
+            nonlocal bulk_rows, vocab
+            with wc.log.step('UP#%(upload_id)d: %(event)s %(rowcount)d rows into %(into)s',
+                             dict(event='bulk insert',
+                                  upload_id=upload_id,
+                                  into=fact_table.name,
+                                  rowcount=len(facts))) as insert_step:
+                facts.validate(stats, lengths, threshold=(0.01, cast(logging.Logger, wc.log)))
+                if self.duplicate_keys:
+                    stats.counts['duplicate key'] += facts.drop_duplicate_keys(
+                        seen, stats, fail=self.duplicate_keys == 'fail')
+                if self.concept_table:
+                    concepts.add(facts.concept_cd[:len(facts)])
+                if self.summary_table and side_tables:
+                    summary.add(facts)
+                if visits is not None:
+                    visits.add(facts)
+                if known is not None:
+                    stats.counts['unknown concept_cd'] += known.check(facts.concept_cd[:len(facts)],
+                                                                      facts.vocab)
+                vocab = facts.vocab
+                bulk_rows += facts.insert(wc._conn, fact_table,
+                                          self.admin_values(fact_upload_id, wc))
+                insert_step.argobj.update(dict(rowsubtotal=bulk_rows))
+                insert_step.msg_parts.append(
+                    ' (subtotal: %(rowsubtotal)d)')
+
+            # report progress via the luigi scheduler and upload_status table
+            # wc, not lc: in a pipeline, the main thread is busy with lc.log's steps
+            _start, elapsed, elapsed_ms = wc.log.elapsed()
+            eta = wc.log.eta(pct_in)
+            message = ('UP#%(upload_id)d %(pct_in)0.2f%% eta %(eta)s '
+                       'loaded %(bulk_rows)d rows @%(rate_out)0.2fK/min %(elapsed)s') % dict(
+                upload_id=upload_id, pct_in=pct_in, eta=eta.strftime('%a %d %b %H:%M'),
+                bulk_rows=bulk_rows, elapsed=elapsed,
+                rate_out=bulk_rows / 1000.0 / (elapsed_ms / 1000000.0 / 60))
+            self.set_status_message(message)
+            wc.execute(upload.table.update()
+                       .where(upload.table.c.upload_id == upload_id)
+                       .values(loaded_record=bulk_rows, end_date=eta,
+                               message=message))
+
+        obs_fact_chunks = self.obs_data(lc, upload_id)
+        with write_stage(self, self.pipeline, 'bulk insert', lc) as submit:
+            while 1:
+                with lc.log.step('UP#%(upload_id)d: %(event)s from %(input)s',
+                                 dict(event='ETL chunk', upload_id=upload_id,
+                                      input=self.input_label)):
+                    with lc.log.step('%(event)s',
+                                     dict(event='get facts')) as step1:
+                        try:
+                            facts, pct_in = next(obs_fact_chunks)
+                        except StopIteration:
+                            break
+                        step1.msg_parts.append(' %(fact_qty)s facts')
+                        step1.argobj.update(dict(fact_qty=len(facts)))
+                    # In a pipeline, the writer gets the facts; we refill a fresh buffer.
+                    submit(partial(write, facts.take() if self.pipeline else facts, pct_in))
+
+        lc.log.info('UP#%(upload_id)d data quality: %(stats)s', dict(upload_id=upload_id, stats=stats))
+        if known is not None:
+            lc.log.info('UP#%(upload_id)d concept codes not in %(ontologies)s: %(known)s',
+                        dict(upload_id=upload_id, ontologies=self.ontology_tables, known=known))
+        if self.concept_table and side_tables and vocab is not None:
+            with lc.log.step('UP#%(upload_id)d: %(event)s into %(into)s',
+                             dict(event='save concepts', upload_id=upload_id,
+                                  into=self.concept_table)) as step:
+                step.argobj.update(dict(concept_qty=concepts.save(lc, self.concept_table, upload_id, vocab)))
+                step.msg_parts.append(': %(concept_qty)d')
+        if self.summary_table and side_tables:
+            with lc.log.step('UP#%(upload_id)d: %(event)s into %(into)s',
+                             dict(event='save summary', upload_id=upload_id,
+                                  into=self.summary_table)) as step:
+                step.argobj.update(dict(group_qty=summary.save(lc, self.summary_table, upload_id)))
+                step.msg_parts.append(': %(group_qty)d groups')
+        if visits is not None:
+            with lc.log.step('UP#%(upload_id)d: %(event)s into %(into)s',
+                             dict(event='save visits', upload_id=upload_id,
+                                  into=self.visit_table)) as step:
+                step.argobj.update(dict(visit_qty=visits.save(lc, self.visit_table, upload_id)))
+                step.msg_parts.append(': %(visit_qty)d')
+        result[upload.table.c.message.name] = 'UP#%d loaded %d rows%s; %s' % (
+            upload_id, bulk_rows,
+            '' if fact_upload_id == upload_id else ' into UP#%d' % fact_upload_id, stats)
+        result[upload.table.c.loaded_record.name] = bulk_rows
+
+    def fact_target(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int,
+                    fact_proto: sqla.Table, result: Params) -> Tuple[sqla.Table, int]:
+        """Make a table for the facts of this upload.
+
+        :return: the table and the upload_id to give its facts
+        """
         fact_table = sqla.Table('observation_fact_%s' % upload_id,
                                 sqla.MetaData(),
                                 *[c.copy() for c in fact_proto.columns],
                                 oracle_compress=True)
         fact_table.create(lc._conn)
-        fact_dtype = {c.name: c.type for c in fact_table.columns
-                      if not c.name.endswith('_blob')}
-        bulk_rows = 0
-        obs_fact_chunks = self.obs_data(lc, upload_id)
-        while 1:
-            with lc.log.step('UP#%(upload_id)d: %(event)s from %(input)s',
-                             dict(event='ETL chunk', upload_id=upload_id,
-                                  input=self.input_label)):
-                with lc.log.step('%(event)s',
-                                 dict(event='get facts')) as step1:
-                    try:
-                        obs_fact_chunk, pct_in = next(obs_fact_chunks)
-                    except StopIteration:
-                        break
-                    step1.msg_parts.append(' %(fact_qty)s facts')
-                    step1.argobj.update(dict(fact_qty=len(obs_fact_chunk)))
-                with lc.log.step('UP#%(upload_id)d: %(event)s %(rowcount)d rows into %(into)s',
-                                 dict(event='bulk insert',
-                                      upload_id=upload_id,
-                                      into=fact_table.name,
-                                      rowcount=len(obs_fact_chunk))) as insert_step:
-                    obs_fact_chunk = _check_start_date(obs_fact_chunk,
-                                                       threshold=(0.01, cast(logging.Logger, lc.log)))
-                    obs_fact_chunk.to_sql(name=fact_table.name,
-                                          con=lc._conn,
-                                          dtype=fact_dtype,
-                                          if_exists='append', index=False)
-                    bulk_rows += len(obs_fact_chunk)
-                    insert_step.argobj.update(dict(rowsubtotal=bulk_rows))
-                    insert_step.msg_parts.append(
-                        ' (subtotal: %(rowsubtotal)d)')
-
-                # report progress via the luigi scheduler and upload_status table
-                _start, elapsed, elapsed_ms = lc.log.elapsed()
-                eta = lc.log.eta(pct_in)
-                message = ('UP#%(upload_id)d %(pct_in)0.2f%% eta %(eta)s '
-                           'loaded %(bulk_rows)d rows @%(rate_out)0.2fK/min %(elapsed)s') % dict(
-                    upload_id=upload_id, pct_in=pct_in, eta=eta.strftime('%a %d %b %H:%M'),
-                    bulk_rows=bulk_rows, elapsed=elapsed,
-                    rate_out=bulk_rows / 1000.0 / (elapsed_ms / 1000000.0 / 60))
-                self.set_status_message(message)
-                lc.execute(upload.table.update()
-                           .where(upload.table.c.upload_id == upload_id)
-                           .values(loaded_record=bulk_rows, end_date=eta,
-                                   message=message))
-        result[upload.table.c.loaded_record.name] = bulk_rows
+        return fact_table, upload_id
+
+    def obs_data(self, lc: LoggedConnection, upload_id: int) -> Iterator[Tuple['FactBuffer', float]]:
+        """Generate facts for each chunk of input.
 
-    def obs_data(self, lc: LoggedConnection, upload_id: int) -> Iterator[Tuple[pd.DataFrame, float]]:
+        The consumer drains each FactBuffer before asking for the next.
+        """
         raise NotImplementedError
 
 
-def read_sql_step(sql: str, lc: LoggedConnection,
+def read_sql_step(sql: Union[str, sqla.sql.expression.Select], lc: LoggedConnection,
                   params: Opt[Params]=None, show_lines: int=1) -> pd.DataFrame:
     with lc.log.step('%(event)s %(sql1)s' + ('\n%(params)s' if params else ''),
                      dict(event='read_sql', sql1=_nlines(str(sql), show_lines), params=params)):
@@ -534,9 +643,296 @@ def _nlines(s: str, n: int) -> str:
     return '\n'.join(s.strip().split('\n')[:n])
 
 
+def read_ahead(log: EventLogger, items: Iterator[T], event: str,
+               depth: int=1) -> Iterator[T]:
+    '''Fetch items in a thread, up to depth items ahead of the consumer.
+
+    Fetching chunks of query results is mostly waiting on the DB,
+    during which the DB driver releases the GIL, so we can work
+    on one chunk while the next one is on its way.
+
+    >>> list(read_ahead(EventLogger(log, {}), iter(range(3)), 'count'))
+    [0, 1, 2]
+
+    Errors are raised in the consumer:
+
+    >>> list(read_ahead(EventLogger(log, {}), (1 // x for x in [1, 0]), 'divide'))
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: integer division or modulo by zero
+
+    The fetches are logged from the thread with their own event
+    logger; the time the consumer spends waiting is logged at the end.
+    '''
+    fetched = queue.Queue(maxsize=depth)  # type: queue.Queue
+    done = object()
+    stopping = threading.Event()
+
+    def fetch() -> None:
+        fetch_log = EventLogger(log.logger, dict(log.event, stage='read ahead'))
+        try:
+            while not stopping.is_set():
+                with fetch_log.step('%(event)s', dict(event=event)):
+                    item = next(items, done)
+                fetched.put((item, None))
+                if item is done:
+                    return
+        except Exception as oops:
+            fetched.put((done, oops))
+
+    reader = threading.Thread(target=fetch, name='read ahead: ' + event, daemon=True)
+    reader.start()
+    waited = 0.0
+    try:
+        while 1:
+            t0 = default_timer()
+            item, oops = fetched.get()
+            waited += default_timer() - t0
+            if oops is not None:
+                raise oops
+            if item is done:
+                break
+            yield cast(T, item)
+    finally:
+        # Unblock the reader, if need be, and wait for it to stop
+        # using the connection.
+        stopping.set()
+        while reader.is_alive():
+            try:
+                fetched.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        log.info('%(event)s: waited %(waited)0.2f sec for read ahead', dict(event=event, waited=waited))
+
+
+def read_ordered(log: EventLogger, parts: List[Iterator[pd.DataFrame]], event: str,
+                 ix_col: str, depth: int=2) -> Iterator[pd.DataFrame]:
+    '''Read parts concurrently, each in its own thread up to depth
+    chunks ahead, but yield their chunks in order of parts, as if
+    they were read one after another.
+
+    Each part numbers its rows (`ix_col`) from 1, as `rownum` does;
+    we offset them by the rows of the parts before, so the numbering
+    is the same as one read of the whole:
+
+    >>> parts = [iter([pd.DataFrame(dict(ix=[1, 2])), pd.DataFrame(dict(ix=[3]))]),
+    ...          iter([pd.DataFrame(dict(ix=[1, 2]))])]
+    >>> [list(chunk['ix']) for chunk in read_ordered(EventLogger(log, {}), parts, 'count', 'ix')]
+    [[1, 2], [3], [4, 5]]
+
+    As with `read_ahead`, errors are raised in the consumer. When
+    the consumer stops, so do the readers; each part is closed
+    (e.g. its connection released) in its reader's thread.
+    '''
+    done = object()
+    stopping = threading.Event()
+    fetched = [queue.Queue(maxsize=depth) for _ in parts]  # type: List[queue.Queue]
+
+    def fetch(items: Iterator[pd.DataFrame], out: queue.Queue, part_event: str) -> None:
+        fetch_log = EventLogger(log.logger, dict(log.event, stage='read part'))
+        try:
+            while not stopping.is_set():
+                with fetch_log.step('%(event)s', dict(event=part_event)):
+                    item = next(items, done)
+                out.put((item, None))
+                if item is done:
+                    return
+        except Exception as oops:
+            out.put((done, oops))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    readers = [threading.Thread(target=fetch, args=(items, out, '%s part %d of %d' % (event, ix + 1, len(parts))),
+                                name='read part: ' + event, daemon=True)
+               for ix, (items, out) in enumerate(zip(parts, fetched))]
+    for reader in readers:
+        reader.start()
+    waited = 0.0
+    offset = 0
+    try:
+        for out in fetched:
+            rows = 0
+            while 1:
+                t0 = default_timer()
+                item, oops = out.get()
+                waited += default_timer() - t0
+                if oops is not None:
+                    raise oops
+                if item is done:
+                    break
+                rows += len(item)
+                if offset:
+                    item[ix_col] += offset
+                yield item
+            offset += rows
+    finally:
+        stopping.set()
+        for reader, out in zip(readers, fetched):
+            while reader.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        log.info('%(event)s: waited %(waited)0.2f sec for %(parts)d readers',
+                 dict(event=event, waited=waited, parts=len(parts)))
+
+
+def split_range(first: int, last: int, cuts: Iterable[int]) -> List[Tuple[int, int]]:
+    '''Split [first, last] into sub-ranges ending at each cut.
+
+    >>> split_range(1, 100, [20, 45, 100])
+    [(1, 20), (21, 45), (46, 100)]
+
+    Cuts outside the range are ignored:
+
+    >>> split_range(1, 100, [0, 150])
+    [(1, 100)]
+    '''
+    ends = _no_dups([cut for cut in sorted(cuts) if first <= cut < last]) + [last]
+    starts = [first] + [end + 1 for end in ends[:-1]]
+    return list(zip(starts, ends))
+
+
+def survey_cuts(ends: List[int], parts: int) -> List[int]:
+    '''Pick parts - 1 of the survey chunk ends within a range, evenly
+    spaced; ntile chunks have about the same number of bene_ids.
+
+    The chunks ending inside the range plus the one that ends with
+    it make len(ends) + 1 pieces:
+
+    >>> survey_cuts([10, 20, 30, 40, 50], 3)
+    [20, 40]
+
+    With fewer pieces than parts, we get fewer cuts:
+
+    >>> survey_cuts([10], 4)
+    [10]
+    >>> survey_cuts([], 4)
+    []
+    '''
+    pieces = len(ends) + 1
+    return _no_dups([ends[k * pieces // parts - 1]
+                     for k in range(1, parts) if k * pieces // parts >= 1])
+
+
+class WriteBehind(object):
+    '''Run writes in a thread, in order, on their own connection.
+
+    While the caller prepares the next chunk, the writer inserts the
+    last one; the caller blocks only when depth writes are waiting.
+
+    >>> class Mock(object):
+    ...     log = EventLogger(log, {})
+    >>> out = []
+    >>> with WriteBehind(cast(LoggedConnection, Mock()), 'append') as writer:
+    ...     for x in range(3):
+    ...         writer.submit(lambda wc, x=x: out.append(x))
+    >>> out
+    [0, 1, 2]
+
+    If a write fails, the error is raised in the caller, at the next
+    submit or at the end; later writes are skipped.
+    '''
+    def __init__(self, writing: LoggedConnection, event: str, depth: int=1) -> None:
+        self.writing = writing
+        self.event = event
+        self.waited = 0.0
+        self._todo = queue.Queue(maxsize=depth)  # type: queue.Queue
+        self._error = None  # type: Opt[Exception]
+        self._thread = threading.Thread(target=self._run, name='write behind: ' + event, daemon=True)
+
+    def __enter__(self) -> 'WriteBehind':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self._todo.put(None)
+        self._thread.join()
+        self.writing.log.info('%(event)s: waited %(waited)0.2f sec for write behind',
+                              dict(event=self.event, waited=self.waited))
+        if exc_type is None:
+            self._check()
+
+    def submit(self, write: Callable[[LoggedConnection], None]) -> None:
+        self._check()
+        t0 = default_timer()
+        self._todo.put(write)
+        self.waited += default_timer() - t0
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while 1:
+            write = self._todo.get()
+            if write is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                write(self.writing)
+            except Exception as oops:
+                self._error = oops
+
+
+@contextmanager
+def write_stage(task: DBAccessTask, pipeline: bool, event: str,
+                lc: Opt[LoggedConnection]=None) -> Iterator[Callable[[Callable[[LoggedConnection], None]], None]]:
+    '''Get a function to submit writes, either behind or inline.
+
+    :param pipeline: if true, run writes in a `WriteBehind` thread
+                     on a second connection
+    :param lc: connection for inline writes; by default,
+               a new connection for each write
+    '''
+    if pipeline:
+        with task.connection(event) as writing:
+            with WriteBehind(writing, event) as writer:
+                yield writer.submit
+    elif lc is not None:
+        inline = lc  # type: LoggedConnection
+        yield lambda write: write(inline)
+    else:
+        def write_connected(write: Callable[[LoggedConnection], None]) -> None:
+            with task.connection(event) as writing:
+                write(writing)
+        yield write_connected
+
+
 class BeneMapped(DataLoadTask):
+    # load only the beneficiaries with mod(ora_hash(bene_id), 100) < bene_sample_pct;
+    # the same ones from every table
+    bene_sample_pct = IntParam(default=100, significant=False)
+
+    @property
+    def transform_name(self) -> str:
+        # Don't let a sample pass for a complete load.
+        if self.bene_sample_pct >= 100:
+            return self.task_id
+        return '%s sample %d%%' % (self.task_id, self.bene_sample_pct)
+
+    def bene_sample(self, bene_id: str) -> str:
+        '''SQL condition (and ...) for the sample of bene_ids, if any.
+        '''
+        if self.bene_sample_pct >= 100:
+            return ''
+        return 'and mod(ora_hash(%s), 100) < %d' % (bene_id, self.bene_sample_pct)
+
+    def bene_sampled(self, q: sqla.sql.expression.Select,
+                     bene_id: sqla.Column) -> sqla.sql.expression.Select:
+        if self.bene_sample_pct >= 100:
+            return q
+        return q.where(sqla.func.mod(sqla.func.ora_hash(bene_id), 100) < self.bene_sample_pct)  # type: ignore
+
     def requires(self) -> List[luigi.Task]:
-        return [PatientMapping()]
+        deps = [PatientMapping()]  # type: List[luigi.Task]
+        if self.visit_table:
+            deps += [SqlScriptTask(script=Script.cms_visit_dimension,
+                                   param_vars=self.vars_for_deps)]
+        return deps
 
     def complete(self) -> bool:
         return (self.output().exists() and
@@ -553,7 +949,9 @@ class BeneMapped(DataLoadTask):
         q = '''select patient_ide bene_id, patient_num from %(I2B2STAR)s.patient_mapping
         where patient_ide_source = :patient_ide_source
         and patient_ide between :bene_id_first and :bene_id_last
-        ''' % dict(I2B2STAR=self.project.star_schema)
+        %(sample)s
+        ''' % dict(I2B2STAR=self.project.star_schema,
+                   sample=self.bene_sample('patient_ide'))
 
         params = dict(patient_ide_source=self.ide_source(key_cols),
                       bene_id_first=bene_range[0],
@@ -578,9 +976,11 @@ class MedparMapped(BeneMapped):
         where medpar.bene_id between :bene_id_first and :bene_id_last
           and emap.patient_ide between :bene_id_first and :bene_id_last
           and emap.encounter_ide_source = :encounter_ide_source
+          %(sample)s
         order by medpar.medpar_id, emap.encounter_num
         ''' % dict(I2B2STAR=self.project.star_schema,
-                   CMS_RIF=self.source.cms_rif)
+                   CMS_RIF=self.source.cms_rif,
+                   sample=self.bene_sample('medpar.bene_id'))
 
         params = dict(encounter_ide_source=self.ide_source(key_cols),
                       bene_id_first=bene_range[0],
@@ -609,27 +1009,158 @@ class MedparMapped(BeneMapped):
         pat_day = out[['bene_id', 'start_day']].drop_duplicates()
 
         # assert(medpar_mapping is 1-1 from medpar_id to encounter_num)
-        pat_enc = pat_day.merge(medpar_mapping, on='bene_id', how='left')
-
-        pat_enc = pat_enc[(pat_enc.start_day >= pat_enc.admsn_dt) &
-                          (pat_enc.start_day <= pat_enc.dschrg_dt)]
+        pat_enc = cls.pat_day_stays(pat_day, medpar_mapping)
         pat_enc = pat_enc.set_index(['bene_id', 'start_day'])  # [['encounter_num', 'medpar_id']]
-        pat_enc = pat_enc[~pat_enc.index.duplicated(keep='first')]
         out = out.merge(pat_enc, how='left', left_on=['bene_id', 'start_day'], right_index=True)
         assert len(out) == len(data)
 
-        # ISSUE: hash is not portable between python and Oracle
-        fallback = - cls.fmt_patient_day(out).apply(hash).abs()
-        out.encounter_num = out.encounter_num.fillna(fallback)
+        fallback = cls.patient_day_hash(out.bene_id, out.start_date)
+        # avoid fillna(): a float round trip would lose bits of the hash
+        out['encounter_num'] = np.where(out.encounter_num.isnull(), fallback,
+                                        out.encounter_num.fillna(0).values.astype(np.int64))
+
+        return out
 
+    @classmethod
+    def pat_day_stays(cls, pat_day: pd.DataFrame, medpar_mapping: pd.DataFrame) -> pd.DataFrame:
+        """Find the stay, if any, that contains each patient-day.
+
+        :param pat_day: distinct bene_id, start_day
+        :param medpar_mapping: with bene_id, admsn_dt, dschrg_dt, ...
+        :return: pat_day rows that fall in a stay, along with the rest
+                 of the medpar_mapping columns for that stay. Where stays
+                 overlap, the first in medpar_mapping wins.
+
+        >>> stays = pd.DataFrame(dict(
+        ...     bene_id=['b1', 'b1', 'b1', 'b2'],
+        ...     medpar_id=['m1', 'm2', 'm3', 'm4'],
+        ...     admsn_dt=pd.to_datetime(['2011-01-10', '2011-01-01', '2011-03-01', '2011-01-01']),
+        ...     dschrg_dt=pd.to_datetime(['2011-01-12', '2011-01-31', '2011-03-05', '2011-01-31'])),
+        ...     columns=['bene_id', 'medpar_id', 'admsn_dt', 'dschrg_dt'])
+        >>> pat_day = pd.DataFrame(dict(
+        ...     bene_id=['b1', 'b1', 'b1', 'b1', 'b2', 'b3'],
+        ...     start_day=pd.to_datetime(['2011-01-05', '2011-01-11', '2011-02-01',
+        ...                               '2011-03-05', '2011-01-11', '2011-01-11'])),
+        ...     columns=['bene_id', 'start_day'])
+        >>> MedparMapped.pat_day_stays(pat_day, stays)
+          bene_id  start_day medpar_id   admsn_dt  dschrg_dt
+        0      b1 2011-01-05        m2 2011-01-01 2011-01-31
+        1      b1 2011-01-11        m1 2011-01-10 2011-01-12
+        3      b1 2011-03-05        m3 2011-03-01 2011-03-05
+        4      b2 2011-01-11        m4 2011-01-01 2011-01-31
+
+        Rather than pairing each patient-day with each stay of the same
+        bene_id, we sort stays by admission and look up, for each
+        patient-day, the latest stay admitted on or before that day,
+        stepping back to earlier stays only while one of them might
+        still have been ongoing.
+        """
+        bene_ixs, _benes = pd.factorize(np.concatenate([medpar_mapping.bene_id.values,
+                                                        pat_day.bene_id.values]))
+        stay_bene, day_bene = bene_ixs[:len(medpar_mapping)], bene_ixs[len(medpar_mapping):]
+        admsn = medpar_mapping.admsn_dt.values.astype('datetime64[ns]').view('i8')
+        dschrg = medpar_mapping.dschrg_dt.values.astype('datetime64[ns]').view('i8')
+        day = pat_day.start_day.values.astype('datetime64[ns]').view('i8')
+        nat = np.datetime64('NaT').astype('datetime64[ns]').view('i8')
+
+        # stays by bene, admission; skip those missing either date
+        live = np.flatnonzero((admsn != nat) & (dschrg != nat))
+        by_admsn = live.take(np.lexsort((admsn.take(live), stay_bene.take(live))))
+        s_bene, s_admsn, s_dschrg = [a.take(by_admsn) for a in [stay_bene, admsn, dschrg]]
+        # latest discharge so far, within each bene
+        s_dschrg_max = pd.Series(s_dschrg).groupby(s_bene).cummax().values
+
+        # Sort stays and days together; a stay admitted on the same day sorts first.
+        ev_bene = np.concatenate([s_bene, day_bene])
+        ev_order = np.lexsort((np.concatenate([np.zeros(len(s_bene)), np.ones(len(day))]),
+                               np.concatenate([s_admsn, day]),
+                               ev_bene))
+        ev_stay = np.concatenate([np.arange(len(s_bene)), np.full(len(day), -1, dtype=int)])
+        # position of latest stay admitted on or before each event
+        latest = np.maximum.accumulate(ev_stay.take(ev_order)) if len(ev_order) else ev_stay
+        is_day = ev_order >= len(s_bene)
+        cand = np.full(len(day), -1, dtype=int)
+        cand[ev_order[is_day] - len(s_bene)] = latest[is_day]
+
+        best = np.full(len(day), len(medpar_mapping), dtype=int)
+        todo = np.arange(len(day))
+        while len(todo):
+            c = cand.take(todo)
+            todo, c = todo[c >= 0], c[c >= 0]
+            ongoing = ((s_bene.take(c) == day_bene.take(todo)) &
+                       (s_dschrg_max.take(c) >= day.take(todo)))
+            todo, c = todo[ongoing], c[ongoing]
+            hit = s_dschrg.take(c) >= day.take(todo)
+            best[todo[hit]] = np.minimum(best[todo[hit]], by_admsn.take(c[hit]))
+            cand[todo] = c - 1
+
+        found = np.flatnonzero(best < len(medpar_mapping))
+        stays = medpar_mapping.drop('bene_id', axis=1).iloc[best.take(found)]
+        out = pat_day.iloc[found].copy()
+        for col in stays.columns:
+            out[col] = stays[col].values
         return out
 
     @classmethod
     def fmt_patient_day(cls, df: pd.DataFrame) -> pd.Series:
-        return df.start_date.dt.strftime('%Y-%m-%d') + ' ' + df.bene_id
+        """Format patient-day keys as fmt_patient_day in cms_keys.pls does.
+        """
+        # strftime gives 'NaT' for null dates, where to_char gives null
+        day = df.start_date.dt.strftime('%Y%m%d').where(df.start_date.notnull(), '')
+        return day + ' ' + df.bene_id
+
+    # See patient_day_hash in cms_keys.pls.
+    hash_multiplier = 2654435761
+
+    @classmethod
+    def patient_day_hash(cls, bene_id: pd.Series, start_date: pd.Series) -> np.ndarray:
+        """Compute fallback encounter_num for patient-days not in any stay.
+
+        We hash the characters of `fmt_patient_day` using arithmetic
+        modulo 2**64 that Oracle can do exactly, so that
+        `patient_day_hash` in cms_keys.pls gets the same result:
+
+        >>> def sql_twin(key):
+        ...     h = 0
+        ...     for c in key:
+        ...         h = (h * MedparMapped.hash_multiplier + ord(c)) % 2 ** 64
+        ...     return -1 - h % (2 ** 63 - 1)
+        >>> pat_day = pd.DataFrame(dict(bene_id=['pt1', 'pt1', 'pt22'],
+        ...                             start_date=pd.to_datetime(['2001-01-01', None, '1999-12-31'])))
+        >>> [sql_twin(key) for key in MedparMapped.fmt_patient_day(pat_day)]
+        [-7611927902321031419, -373165180439335158, -1756915063467103420]
+        >>> MedparMapped.patient_day_hash(pat_day.bene_id, pat_day.start_date)
+        array([-7611927902321031419,  -373165180439335158, -1756915063467103420])
+
+        Rather than formatting strings, we fold in the date digits
+        arithmetically and the bene_id bytes a column at a time.
+        """
+        if len(bene_id) == 0:
+            return np.zeros(0, dtype=np.int64)
+        m = np.uint64(cls.hash_multiplier)
+        dt = start_date.values.astype('datetime64[D]')
+        has_date = ~pd.isnull(dt)
+        year = dt.astype('datetime64[Y]').astype(np.int64) + 1970
+        month = dt.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        day = (dt - dt.astype('datetime64[M]')).astype(np.int64) + 1
+
+        h = np.zeros(len(dt), dtype=np.uint64)
+        for part, width in [(year, 4), (month, 2), (day, 2)]:  # YYYYMMDD
+            for place in reversed(range(width)):
+                digit = (ord('0') + part // 10 ** place % 10).astype(np.uint64)
+                h = np.where(has_date, h * m + digit, h)
+        h = h * m + np.uint64(ord(' '))
+
+        ids = bene_id.values.astype('S')
+        id_len = np.char.str_len(ids)
+        id_bytes = ids.view(np.uint8).reshape(len(ids), -1)
+        for pos in range(id_bytes.shape[1]):
+            h = np.where(pos < id_len, h * m + id_bytes[:, pos], h)
+        return -1 - (h % np.uint64(2 ** 63 - 1)).astype(np.int64)
 
     def with_mapping(self, data: pd.DataFrame,
-                     pmap: pd.DataFrame, emap: pd.DataFrame) -> pd.DataFrame:
+                     pmap: pd.DataFrame, emap: pd.DataFrame,
+                     vocab: Opt['Vocabulary']=None) -> pd.DataFrame:
         obs = data.merge(pmap, on=CMSVariables.bene_id)
 
         if 'medpar_id' in data.columns.values:
@@ -641,6 +1172,8 @@ class MedparMapped(BeneMapped):
             obs.provider_id = obs.provider_id.where(~obs.provider_id.isnull(), '@')
         else:
             obs['provider_id'] = '@'
+        if vocab is not None:
+            obs['provider_id'] = vocab.encode(obs.provider_id.values)
 
         return obs
 
@@ -686,12 +1219,15 @@ class CMSVariables(object):
 
     curated_info = 'metadata/active_columns.csv'
     _active_columns = pkg.resource_string(__name__, curated_info)
+    _curated = None  # type: Opt[pd.DataFrame]
 
     @classmethod
     def active_columns(cls, table_name: str,
                        extras: Iterable[str]=[],
                        active: str='A') -> pd.DataFrame:
-        col_info = pd.read_csv(StringIO(cls._active_columns.decode('utf-8')))
+        if CMSVariables._curated is None:
+            CMSVariables._curated = pd.read_csv(StringIO(cls._active_columns.decode('utf-8')))
+        col_info = CMSVariables._curated
         return col_info[(col_info.table_name == table_name.lower()) &
                         (~col_info.Status.isnull() |
                          col_info.column_name.str.lower().isin(extras))]
@@ -827,18 +1363,1268 @@ def fmt_px_codes(prcdr_cd: pd.Series, prcdr_vrsn: pd.Series,
     7  PROC|14:001MT
     '''
     assert all(~prcdr_cd.isnull())
-    is_other = prcdr_vrsn.isin(other_vrsns)
-    is_hcpcs = ~is_other & prcdr_vrsn.isin(hcpcs_vrsns)
-    is_cpt = is_hcpcs & ~prcdr_cd.str.match('^[A-Z]', as_indexer=True)
-    cpt = 'CPT:' + prcdr_cd[is_cpt]
-    hcpcs = 'HCPCS:' + prcdr_cd[is_hcpcs & ~is_cpt]
+    is_other = prcdr_vrsn.isin(other_vrsns).values
+    is_hcpcs = ~is_other & prcdr_vrsn.isin(hcpcs_vrsns).values
+    is_cpt = is_hcpcs & ~prcdr_cd.str.match('^[A-Z]', as_indexer=True).values
+    is_icd9 = ~is_hcpcs & ~is_other
+
+    # Fill in each kind by position; the index may have dups.
+    out = np.empty(len(prcdr_cd), dtype=object)
+    out[is_cpt] = 'CPT:' + prcdr_cd[is_cpt]
+    out[is_hcpcs & ~is_cpt] = 'HCPCS:' + prcdr_cd[is_hcpcs & ~is_cpt]
+    icd9 = prcdr_cd[is_icd9]
+    out[is_icd9] = 'ICD9:' + icd9.where(icd9.str.len() <= 2,
+                                        icd9.str[:2] + '.' + icd9.str[2:])
+    out[is_other] = 'PROC|' + prcdr_vrsn[is_other] + ':' + prcdr_cd[is_other]
+    return pd.Series(out, index=prcdr_cd.index)
+
+
+class Vocabulary(object):
+    '''Growing dictionary of fact codes (concept_cd, modifier_cd, provider_id).
+
+    Most concept codes repeat from one chunk of an upload to the next,
+    so rather than carrying millions of short strings in each fact
+    frame, we carry small integer codes into a dictionary shared by
+    all chunks of the upload:
+
+    >>> vocab = Vocabulary()
+    >>> vocab.encode(np.array(['ICD9:250.00', 'CPT:99213', None, 'ICD9:250.00'], dtype=object))
+    array([ 0,  1, -1,  0], dtype=int32)
+    >>> vocab.encode(np.array(['DRG:123', 'CPT:99213'], dtype=object))
+    array([2, 1], dtype=int32)
+
+    Strings are only materialized when the facts are written; until
+    then, fact frames hold categoricals backed by the shared dictionary::
+
+    >>> obs = pd.DataFrame(dict(concept_cd=[2, 0, 1], instance_num=[0, 1, 2]))
+    >>> list(vocab.as_categories(obs, ['concept_cd']).concept_cd)
+    ['DRG:123', 'ICD9:250.00', 'CPT:99213']
+    '''
+    code_dtype = np.int32
+    fact_columns = ['concept_cd', 'modifier_cd', 'provider_id']
+
+    def __init__(self) -> None:
+        self._codes = {}  # type: Dict[str, int]
+        self._labels = []  # type: List[str]
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def intern(self, labels: Iterable[str]) -> np.ndarray:
+        '''Get codes for labels, adding any new ones to the dictionary.
+        '''
+        codes = self._codes
+        for label in labels:
+            if label not in codes:
+                codes[label] = len(self._labels)
+                self._labels.append(label)
+        return np.array([codes[label] for label in labels], dtype=self.code_dtype)
+
+    def encode(self, values: np.ndarray) -> np.ndarray:
+        '''Encode an array of labels, looking up each distinct label once.
+
+        Null values get code -1, as in `pd.Categorical`.
+        '''
+        ixs, uniques = pd.factorize(values)
+        # append -1 so that null (ix -1) maps to -1
+        codes = np.append(self.intern(list(uniques)), -1).astype(self.code_dtype)
+        return codes.take(ixs)
+
+    def labels(self, start: int=0) -> List[str]:
+        return self._labels[start:]
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        '''Get labels for codes; None for -1.
+        '''
+        labels = np.empty(len(self._labels) + 1, dtype=object)
+        labels[:-1] = self._labels
+        return labels.take(codes)
+
+    def categorical(self, codes: np.ndarray) -> pd.Categorical:
+        return pd.Categorical.from_codes(codes, categories=self._labels)
+
+    def as_categories(self, obs: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+        '''Turn encoded columns into categoricals backed by this vocabulary.
+        '''
+        out = obs.copy()
+        for col in columns:
+            if col in out.columns.values and out[col].dtype.kind == 'i':
+                out[col] = self.categorical(out[col].values)
+        return out
+
+
+class CodeFormat(object):
+    '''Memoized formatting of (version, code) pairs.
+
+    There are millions of diagnosis and procedure facts per upload, but
+    only thousands of distinct codes, so we format each distinct pair
+    once and map the results back by position:
+
+    >>> calls = []
+    >>> def fmt(vrsn, cd):
+    ...     calls.append(len(cd))
+    ...     return fmt_dx_codes(vrsn, cd)
+    >>> dx_format = CodeFormat(fmt)
+    >>> list(dx_format(pd.Series(['9', '9', None, '9']), pd.Series(['25000', '4019', '4019', '25000'])))
+    ['ICD9:250.00', 'ICD9:401.9', 'ICD9:401.9', 'ICD9:250.00']
+
+    Results are remembered from one chunk of an upload to the next;
+    only new pairs get formatted:
+
+    >>> dx_format(pd.Series(['10', '9']), pd.Series(['E119', '25000']))
+    array(['ICD10:E11.9', 'ICD9:250.00'], dtype=object)
+    >>> calls
+    [3, 1]
+
+    With a vocabulary, we get codes rather than labels:
 
-    icd9 = prcdr_cd[~is_hcpcs & ~is_other]
-    icd9 = icd9.where(icd9.str.len() <= 2,
-                      icd9.str[:2] + '.' + icd9.str[2:])
-    icd9 = 'ICD9:' + icd9
-    other = 'PROC|' + prcdr_vrsn[is_other] + ':' + prcdr_cd[is_other]
-    return icd9.append([cpt, hcpcs, other])[prcdr_cd.index]
+    >>> vocab = Vocabulary()
+    >>> dx_format(pd.Series(['9', '9']), pd.Series(['4019', '25000']), vocab=vocab)
+    array([0, 1], dtype=int32)
+
+    The cache is bounded; once it has `capacity` pairs, it starts over.
+    '''
+    def __init__(self, fmt: Callable[[pd.Series, pd.Series], pd.Series],
+                 capacity: int=2 ** 17) -> None:
+        self._fmt = fmt
+        self._capacity = capacity
+        self._cache = {}  # type: Dict[Tuple[Any, Any], str]
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def __call__(self, vrsn: pd.Series, code: pd.Series,
+                 vocab: Opt[Vocabulary]=None) -> np.ndarray:
+        pair_ixs, vrsns, codes = _factorize_pairs(vrsn.values, code.values)
+        labels = self.labels(vrsns, codes)
+        if vocab is None:
+            return np.array(labels, dtype=object).take(pair_ixs)
+        return vocab.intern(labels).take(pair_ixs)
+
+    def labels(self, vrsns: np.ndarray, codes: np.ndarray) -> List[str]:
+        '''Format distinct pairs, consulting the cache first.
+        '''
+        cache = self._cache
+        keys = list(zip(vrsns, codes))
+        todo = [ix for ix, key in enumerate(keys) if key not in cache]
+        if todo:
+            if len(cache) + len(todo) > self._capacity:
+                cache.clear()
+            done = self._fmt(pd.Series(vrsns.take(todo)), pd.Series(codes.take(todo)))
+            cache.update(zip([keys[ix] for ix in todo], done.values))
+        return [cache[key] for key in keys]
+
+
+def _factorize_pairs(xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Factorize (x, y) pairs.
+
+    :return: ixs, x_uniques, y_uniques such that
+             x_uniques[ixs] == xs and y_uniques[ixs] == ys
+
+    >>> ixs, vs, cs = _factorize_pairs(np.array(['9', '9', None, '9'], dtype=object),
+    ...                                np.array(['250', '401', '401', '250'], dtype=object))
+    >>> ixs, list(vs), list(cs)
+    (array([0, 1, 2, 0]), ['9', '9', None], ['250', '401', '401'])
+    '''
+    def factorize(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        ixs, uniques = pd.factorize(values)
+        # nulls (ix -1) go last
+        uniques = np.append(np.asarray(uniques, dtype=object), None)
+        return np.where(ixs < 0, len(uniques) - 1, ixs), uniques
+
+    x_ixs, x_uniques = factorize(xs)
+    y_ixs, y_uniques = factorize(ys)
+    ixs, pairs = pd.factorize(x_ixs * len(y_uniques) + y_ixs)
+    return ixs, x_uniques.take(pairs // len(y_uniques)), y_uniques.take(pairs % len(y_uniques))
+
+
+dx_code_format = CodeFormat(fmt_dx_codes)
+px_code_format = CodeFormat(lambda prcdr_vrsn, prcdr_cd: fmt_px_codes(prcdr_cd, prcdr_vrsn))
+
+
+class FactBuffer(object):
+    '''Typed, column-oriented buffer of observation facts.
+
+    Rather than carrying facts from pivot to database in wide frames of
+    python objects (and copying them at each step), we append them
+    to preallocated numpy arrays: integers for `patient_num` etc.,
+    floats for `nval_num` etc., `datetime64` for dates, and vocabulary
+    codes for `concept_cd` etc.
+
+    >>> vocab = Vocabulary()
+    >>> facts = FactBuffer(vocab, capacity=2)
+    >>> facts.append(pd.DataFrame(dict(
+    ...     patient_num=[1, 2, 2], encounter_num=[-5, 11, 11], instance_num=[0, 0, 1000],
+    ...     concept_cd=['DRG:123', 'DRG:45', 'BENE_AGE_CNT:'], valtype_cd=['@', '@', 'N'],
+    ...     modifier_cd='@', provider_id='@', nval_num=[None, None, 67],
+    ...     start_date=pd.to_datetime(['2011-01-01', '2011-02-01', None]),
+    ...     bene_id=['b1', 'b2', 'b2'])))
+    >>> len(facts), facts.patient_num[:len(facts)], facts.concept_cd[:len(facts)]
+    (3, array([1, 2, 2]), array([0, 1, 2], dtype=int32))
+
+    The writer drains the buffer a batch of rows at a time;
+    `frame` is handy for a look at the contents:
+
+    >>> facts.frame()[['patient_num', 'concept_cd', 'start_date', 'nval_num']]
+       patient_num     concept_cd start_date  nval_num
+    0            1        DRG:123 2011-01-01       NaN
+    1            2         DRG:45 2011-02-01       NaN
+    2            2  BENE_AGE_CNT:        NaT      67.0
+
+    Before writing, we check the facts and drop those with no
+    `start_date` or codes that won't fit, subject to a threshold:
+
+    >>> facts.validate(FactStats(), dict(concept_cd=6), threshold=(0.5, log))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    ValueError: 2 of 3 records with values too long for ['concept_cd']:
+    ...
+    >>> stats = FactStats()
+    >>> facts.validate(stats, dict(concept_cd=6), threshold=(0.7, log))
+    >>> len(facts), list(facts.frame().concept_cd)
+    (1, ['DRG:45'])
+    >>> print(stats)  # doctest: +ELLIPSIS
+    facts: 3; concept_cd too long: 2 (66.67%); ... null start_date: 1 (33.33%); ... valtype_cd N: 1 (33.33%)
+    '''
+    __slots__ = ['vocab', 'capacity', 'size',
+                 'patient_num', 'encounter_num', 'instance_num',
+                 'concept_cd', 'modifier_cd', 'provider_id', 'valtype_cd',
+                 'start_date', 'end_date', 'update_date',
+                 'nval_num', 'quantity_num', 'confidence_num',
+                 'tval_char']
+
+    int_columns = ['patient_num', 'encounter_num', 'instance_num']
+    code_columns = Vocabulary.fact_columns + ['valtype_cd']
+    date_columns = ['start_date', 'end_date', 'update_date']
+    num_columns = ['nval_num', 'quantity_num', 'confidence_num']
+    text_columns = ['tval_char']
+    columns = int_columns + code_columns + date_columns + num_columns + text_columns
+    key_columns = ['patient_num', 'concept_cd', 'modifier_cd', 'start_date',
+                   'encounter_num', 'instance_num', 'provider_id']
+    date_dtype = 'datetime64[s]'  # wide range; i2b2 dates don't need more precision
+
+    def __init__(self, vocab: Vocabulary, capacity: int=2 ** 16) -> None:
+        self.vocab = vocab
+        self.size = 0
+        self.capacity = capacity
+        # One array per column, of which the first size rows are in use; see _allocate.
+        self.patient_num = None  # type: np.ndarray
+        self.encounter_num = None  # type: np.ndarray
+        self.instance_num = None  # type: np.ndarray
+        self.concept_cd = None  # type: np.ndarray
+        self.modifier_cd = None  # type: np.ndarray
+        self.provider_id = None  # type: np.ndarray
+        self.valtype_cd = None  # type: np.ndarray
+        self.start_date = None  # type: np.ndarray
+        self.end_date = None  # type: np.ndarray
+        self.update_date = None  # type: np.ndarray
+        self.nval_num = None  # type: np.ndarray
+        self.quantity_num = None  # type: np.ndarray
+        self.confidence_num = None  # type: np.ndarray
+        self.tval_char = None  # type: np.ndarray
+        self._allocate(capacity)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _allocate(self, capacity: int) -> None:
+        self.capacity = capacity
+        for name in self.columns:
+            old = getattr(self, name, None)
+            new = self._empty(name, capacity)
+            if old is not None:
+                new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    @classmethod
+    def _empty(cls, name: str, qty: int) -> np.ndarray:
+        if name in cls.int_columns:
+            return np.zeros(qty, dtype=np.int64)
+        if name in cls.code_columns:
+            return np.full(qty, -1, dtype=Vocabulary.code_dtype)
+        if name in cls.date_columns:
+            return np.full(qty, np.datetime64('NaT'), dtype=cls.date_dtype)
+        if name in cls.num_columns:
+            return np.full(qty, np.nan)
+        return np.full(qty, None, dtype=object)
+
+    @classmethod
+    def row_bytes(cls) -> int:
+        '''Storage per fact (not counting text).
+
+        >>> FactBuffer.row_bytes()
+        96
+        '''
+        return sum(cls._empty(name, 1).itemsize for name in cls.columns)
+
+    def clear(self) -> None:
+        '''Empty the buffer, keeping its storage for the next chunk.
+        '''
+        self.size = 0
+
+    def take(self) -> 'FactBuffer':
+        '''Hand the contents over to a new buffer and start this one afresh;
+        e.g. to write one chunk while filling the next.
+        '''
+        out = FactBuffer(self.vocab, 0)
+        out.capacity, out.size = self.capacity, self.size
+        for name in self.columns:
+            setattr(out, name, getattr(self, name))
+            delattr(self, name)
+        self.size = 0
+        self._allocate(self.capacity)
+        return out
+
+    def append(self, obs: pd.DataFrame, labels: Opt[List[str]]=None) -> None:
+        '''Append facts from a frame such as `with_mapping` produces.
+
+        Columns that aren't observation_fact columns are ignored.
+
+        :param labels: if integer codes in obs are from some other
+                       vocabulary (e.g. in a worker process),
+                       its labels, to translate codes to this one.
+        '''
+        lo, hi = self.size, self.size + len(obs)
+        if hi > self.capacity:
+            self._allocate(max(hi, 2 * self.capacity))
+        if labels is not None:
+            translate = np.append(self.vocab.intern(labels), -1).astype(Vocabulary.code_dtype)
+        for name in self.columns:
+            target = getattr(self, name)
+            if name not in obs.columns.values:
+                target[lo:hi] = self._empty(name, 1)[0]
+                continue
+            values = obs[name].values
+            if name in self.int_columns:
+                if pd.isnull(values).any():
+                    raise ValueError('null %s' % name)
+                target[lo:hi] = values
+            elif name in self.code_columns:
+                if values.dtype.kind != 'i':
+                    target[lo:hi] = self.vocab.encode(values)
+                elif labels is not None:
+                    target[lo:hi] = translate.take(values)
+                else:
+                    target[lo:hi] = values
+            elif name in self.date_columns:
+                target[lo:hi] = self._dates(values)
+            else:
+                target[lo:hi] = values
+        self.size = hi
+
+    @classmethod
+    def _dates(cls, values: np.ndarray) -> np.ndarray:
+        if values.dtype.kind == 'M':
+            return values.astype(cls.date_dtype)
+        # datetime.date, Timestamp objects, with None or NaN for null
+        return np.where(pd.isnull(values), None, values).astype(cls.date_dtype)
+
+    @classmethod
+    def column_lengths(cls, table: sqla.Table) -> Dict[str, int]:
+        '''Maximum lengths of code and text columns of a table.
+        '''
+        return {col.name: col.type.length for col in table.columns
+                if (col.name in cls.code_columns + cls.text_columns and
+                    getattr(col.type, 'length', None))}
+
+    def validate(self, stats: 'FactStats', lengths: Dict[str, int],
+                 threshold: Opt[Tuple[float, logging.Logger]]=None) -> None:
+        '''Check the facts in one pass, counting nulls, out-of-range
+        dates, over-length codes, and facts per valtype in stats.
+
+        Then drop facts with no start_date or with values too long
+        for their columns, all at once.
+
+        :param lengths: maximum lengths; see `column_lengths`
+        :param threshold: fraction of facts with no start_date (and,
+                          separately, with values too long) that we
+                          can drop (with a warning to the logger)
+                          rather than raise ValueError
+        '''
+        tot = self.size
+        if tot == 0:
+            return
+        counts = stats.counts
+        counts['facts'] += tot
+        for name in self.date_columns + self.num_columns:
+            counts['null ' + name] += int(pd.isnull(getattr(self, name)[:tot]).sum())
+
+        start = self.start_date[:tot]
+        no_start = pd.isnull(start)
+        if stats.date_range is not None:
+            lo, hi = stats.date_range
+            known = start[~no_start]
+            counts['start_date out of range'] += int(((known < lo) | (known > hi)).sum())
+
+        too_long = np.zeros(tot, dtype=bool)
+        label_lengths = np.array([len(label) for label in self.vocab.labels()] + [0])
+        for name, limit in sorted(lengths.items()):
+            if name in self.code_columns:
+                over = label_lengths.take(getattr(self, name)[:tot]) > limit
+            else:
+                over = pd.Series(getattr(self, name)[:tot]).str.len().fillna(0).values > limit
+            counts[name + ' too long'] += int(over.sum())
+            too_long |= over
+
+        valtypes = self.valtype_cd[:tot]
+        for code, qty in zip(*np.unique(valtypes, return_counts=True)):
+            counts['valtype_cd %s' % self.vocab.decode(np.array([code]))[0]] += int(qty)
+
+        for problem, bad in [('null start_date', no_start),
+                             ('values too long for %s' % sorted(lengths.keys()), too_long)]:
+            bad_qty = int(bad.sum())
+            if bad_qty > 0:
+                if threshold is None or bad_qty * 1.0 / tot > threshold[0]:
+                    raise ValueError('%d of %d records with %s:\n%s' % (
+                        bad_qty, tot, problem, self.frame(np.flatnonzero(bad)[:5])))
+                threshold[1].warning('ignoring %d (%f%%) records with %s',
+                                     bad_qty, 100.0 * bad_qty / tot, problem)
+        drop = no_start | too_long
+        if drop.any():
+            self._keep(np.flatnonzero(~drop))
+
+    def _keep(self, keep: np.ndarray) -> None:
+        for name in self.columns:
+            target = getattr(self, name)
+            target[:len(keep)] = target.take(keep)
+        self.size = len(keep)
+
+    def key_hashes(self) -> np.ndarray:
+        '''64 bit hashes of the observation_fact primary key of each fact.
+
+        Codes stand in for concept_cd etc.; they're consistent across the
+        chunks of an upload, since they share a vocabulary.
+        '''
+        tot = self.size
+        out = np.zeros(tot, dtype=np.uint64)
+        for name in self.key_columns:
+            values = getattr(self, name)[:tot]
+            if name in self.date_columns:
+                values = values.view(np.int64)
+            out = _mix64(out ^ _mix64(values.astype(np.int64).view(np.uint64)))
+        return out
+
+    def drop_duplicate_keys(self, seen: 'SeenKeys', stats: 'FactStats', fail: bool=False) -> int:
+        '''Drop facts whose primary key is already in the buffer;
+        then add the rest to seen.
+
+        >>> vocab = Vocabulary()
+        >>> facts = FactBuffer(vocab)
+        >>> chunk = pd.DataFrame(dict(
+        ...     patient_num=[1, 1, 2], encounter_num=11, instance_num=0, concept_cd='DRG:1',
+        ...     modifier_cd='@', provider_id='@', start_date=pd.to_datetime('2011-01-01')))
+        >>> facts.append(chunk)
+        >>> seen, stats = SeenKeys(), FactStats()
+        >>> facts.drop_duplicate_keys(seen, stats), len(facts), len(seen)
+        (1, 2, 2)
+
+        Facts with the same key hash in one buffer are compared column
+        by column before they're dropped. Only the hashes of earlier
+        chunks are kept, so a hit there can't be confirmed; such facts
+        are kept (for the primary key to judge) and counted:
+
+        >>> facts.clear()
+        >>> facts.append(chunk.assign(patient_num=[2, 3, 4]))
+        >>> facts.drop_duplicate_keys(seen, stats), len(facts), stats.counts['duplicate key hash']
+        (0, 3, 1)
+
+        With fail=True, either sort of duplicate is an error:
+
+        >>> facts.drop_duplicate_keys(seen, stats, fail=True)  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+          ...
+        ValueError: 3 facts with duplicate keys; e.g.:
+        ...
+
+        :param fail: raise ValueError, with some of the facts, rather than drop them
+        :return: number of facts dropped
+        '''
+        hashes = self.key_hashes()
+        dup = np.zeros(len(hashes), dtype=bool)
+        candidates = np.flatnonzero(pd.Series(hashes).duplicated(keep=False).values)
+        if len(candidates) > 0:
+            keys = pd.DataFrame({name: getattr(self, name).take(candidates)
+                                 for name in self.key_columns})
+            dup[candidates[keys.duplicated().values]] = True
+        earlier = seen.contains(hashes) & ~dup
+        if fail and (dup.any() or earlier.any()):
+            bad = dup | earlier
+            raise ValueError('%d facts with duplicate keys; e.g.:\n%s' % (
+                bad.sum(), self.frame(np.flatnonzero(bad)[:5])[self.key_columns]))
+        stats.counts['duplicate key hash'] += int(earlier.sum())
+        qty = int(dup.sum())
+        if qty > 0:
+            self._keep(np.flatnonzero(~dup))
+        seen.add(hashes[~dup])
+        return qty
+
+    def values(self, name: str, lo: int, hi: int) -> List[Any]:
+        '''Python values (None for null) for DB-API, from rows lo to hi.
+        '''
+        values = getattr(self, name)[lo:hi]
+        if name in self.code_columns:
+            return list(self.vocab.decode(values))
+        if name in self.date_columns:
+            return list(values.astype(object))  # NaT -> None
+        if name in self.num_columns:
+            return [None if x != x else x for x in values.tolist()]
+        return cast(List[Any], values.tolist())
+
+    def frame(self, rows: Opt[np.ndarray]=None) -> pd.DataFrame:
+        '''Materialize (some of) the buffer as a frame.
+        '''
+        if rows is None:
+            rows = np.arange(self.size)
+        return pd.DataFrame({name: (self.vocab.decode(getattr(self, name).take(rows))
+                                    if name in self.code_columns else
+                                    getattr(self, name).take(rows))
+                             for name in self.columns},
+                            columns=self.columns)
+
+    def insert(self, conn: sqla.engine.Connection, table: sqla.Table,
+               admin: Dict[str, Any], batch_size: int=10000) -> int:
+        '''Drain the buffer into table, batch_size rows at a time.
+
+        :param admin: values for sourcesystem_cd, upload_id, etc.
+        :return: number of rows inserted
+        '''
+        names = [col.name for col in table.columns
+                 if col.name in self.columns or col.name in admin]
+        for lo in range(0, self.size, batch_size):
+            hi = min(lo + batch_size, self.size)
+            cols = [self.values(name, lo, hi) if name in self.columns else [admin[name]] * (hi - lo)
+                    for name in names]
+            conn.execute(table.insert(), [dict(zip(names, row)) for row in zip(*cols)])
+        qty = self.size
+        self.clear()
+        return qty
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    '''splitmix64 finalizer, elementwise.
+    '''
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class SeenKeys(object):
+    '''Set of 64 bit key hashes, kept as a few sorted runs.
+
+    Each batch of hashes adds a run; runs of similar size are merged,
+    so there are O(log n) of them to search:
+
+    >>> seen = SeenKeys()
+    >>> for lo in range(0, 8, 2):
+    ...     seen.add(np.arange(lo, lo + 2, dtype=np.uint64))
+    >>> len(seen), [len(run) for run in seen.runs]
+    (8, [6, 2])
+    >>> seen.contains(np.array([3, 9], dtype=np.uint64)).tolist()
+    [True, False]
+
+    A chunk may contribute no keys at all (all dropped or duplicates):
+
+    >>> seen.add(np.array([], dtype=np.uint64))
+    >>> [len(run) for run in seen.runs], seen.contains(np.array([7, 8], dtype=np.uint64)).tolist()
+    ([6, 2], [True, False])
+    '''
+    def __init__(self) -> None:
+        self.runs = []  # type: List[np.ndarray]
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            if len(run) == 0:
+                continue
+            ix = np.searchsorted(run, hashes).clip(0, len(run) - 1)
+            found |= run.take(ix) == hashes
+        return found
+
+    def add(self, hashes: np.ndarray) -> None:
+        run = np.unique(hashes)
+        if len(run) == 0:
+            return
+        while self.runs and len(self.runs[-1]) <= 2 * len(run):
+            run = np.unique(np.concatenate([self.runs.pop(), run]))
+        self.runs.append(run)
+
+
+class ClaimDates(object):
+    '''Claim dates indexed by clm_id: sorted ids and dates to match.
+
+    >>> dates = ClaimDates([
+    ...     (ClaimDates.compact_ids(np.array(['c3', 'c1'], dtype=object)),
+    ...      pd.to_datetime(['2001-03-01', '2001-01-01']).values),
+    ...     (ClaimDates.compact_ids(np.array(['c2'], dtype=object)),
+    ...      pd.to_datetime(['2001-02-01']).values)])
+    >>> len(dates)
+    3
+
+    Look up dates for many claims at once, with a default
+    for claims we don't know:
+
+    >>> found = dates.lookup(np.array(['c1', 'c9', 'c3'], dtype=object),
+    ...                      default=pd.to_datetime(['2009-01-01'] * 3).values)
+    >>> [str(d)[:10] for d in found]
+    ['2001-01-01', '2009-01-01', '2001-03-01']
+
+    The ids are stored as bytes rather than python strings; a million
+    claims take roughly 25MB.
+    '''
+    max_shared = 2
+
+    def __init__(self, parts: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+        ids = np.concatenate([ids for ids, _ in parts]) if parts else np.array([], dtype='S1')
+        dates = (np.concatenate([dates for _, dates in parts]).astype('datetime64[ns]') if parts
+                 else np.array([], dtype='datetime64[ns]'))
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids.take(order)
+        self.dates = dates.take(order)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def compact_ids(cls, clm_id: np.ndarray) -> np.ndarray:
+        return np.asarray(clm_id).astype('S')
+
+    @classmethod
+    def share(cls, key: Tuple[str, int, int, int], dates: 'ClaimDates') -> None:
+        '''Keep dates for the last few (claim table, bene_id_first, bene_id_last, bene_sample_pct).
+        '''
+        _claim_dates[key] = dates
+        while len(_claim_dates) > cls.max_shared:
+            _claim_dates.popitem(last=False)
+
+    def lookup(self, clm_id: np.ndarray, default: np.ndarray) -> np.ndarray:
+        default = default.astype('datetime64[ns]')
+        if len(self.ids) == 0:
+            return default
+        want = self.compact_ids(clm_id)
+        ix = np.minimum(np.searchsorted(self.ids, want), len(self.ids) - 1)
+        return np.where(self.ids.take(ix) == want, self.dates.take(ix), default)
+
+
+_claim_dates = OrderedDict()  # type: OrderedDict[Tuple[str, int, int, int], ClaimDates]
+
+
+class FactStats(object):
+    '''Data quality counters, accumulated over the chunks of an upload.
+
+    See `FactBuffer.validate`.
+
+    :param date_range: range of plausible start dates
+    '''
+    def __init__(self, date_range: Opt[Tuple[np.datetime64, np.datetime64]]=None) -> None:
+        self.date_range = date_range
+        self.counts = Counter()  # type: Dict[str, int]
+
+    def __str__(self) -> str:
+        tot = self.counts['facts']
+        return '; '.join(['facts: %d' % tot] + [
+            '%s: %d (%0.2f%%)' % (name, qty, 100.0 * qty / tot)
+            for name, qty in sorted(self.counts.items())
+            if name != 'facts' and qty > 0])
+
+
+class KnownCodes(object):
+    '''Which concept codes some ontology has as a basecode.
+
+    The basecodes of all the ontologies fit in one sorted array;
+    each vocabulary code is looked up once, so checking a chunk
+    of facts is just a `take`:
+
+    >>> known = KnownCodes(['ICD9:250.00', 'CPT:99213', 'ICD9:401.9'])
+    >>> vocab = Vocabulary()
+    >>> codes = vocab.encode(np.array(['ICD9:250.00', 'ICD9:999.9', 'DRG:1', 'ICD9:999.9'], dtype=object))
+    >>> known.check(codes, vocab)
+    3
+    >>> known.check(vocab.encode(np.array(['CPT:99213', 'ICD9:123.4'], dtype=object)), vocab)
+    1
+    >>> print(known)
+    DRG: 1 of 1 unknown e.g. ['DRG:1']; ICD9: 3 of 4 unknown e.g. ['ICD9:999.9', 'ICD9:123.4']
+
+    Unknown codes are counted per scheme (prefix), with a sample of each.
+    '''
+    def __init__(self, basecodes: Iterable[str], sample_size: int=5) -> None:
+        self.basecodes = np.unique(np.array(list(basecodes), dtype=object))
+        self.sample_size = sample_size
+        self._known = np.zeros(0, dtype=bool)  # by vocabulary code
+        self._scheme = np.zeros(0, dtype=np.int32)
+        self._schemes = OrderedDict()  # type: Dict[str, int]
+        self.checked = np.zeros(0, dtype=np.int64)  # by scheme
+        self.unknown = np.zeros(0, dtype=np.int64)
+        self.samples = {}  # type: Dict[str, List[str]]
+
+    def _learn(self, vocab: Vocabulary) -> None:
+        labels = np.array(vocab.labels(len(self._known)), dtype=object)
+        if len(labels) == 0:
+            return
+        ix = np.searchsorted(self.basecodes, labels).clip(0, max(len(self.basecodes) - 1, 0))
+        known = (self.basecodes.take(ix) == labels) if len(self.basecodes) else np.zeros(len(labels), dtype=bool)
+        scheme = [self._schemes.setdefault(label.partition(':')[0] + ':', len(self._schemes))
+                  for label in labels]
+        self._known = np.append(self._known, known)
+        self._scheme = np.append(self._scheme, np.array(scheme, dtype=np.int32))
+        grow = len(self._schemes) - len(self.checked)
+        self.checked = np.append(self.checked, np.zeros(grow, dtype=np.int64))
+        self.unknown = np.append(self.unknown, np.zeros(grow, dtype=np.int64))
+
+    def check(self, codes: np.ndarray, vocab: Vocabulary) -> int:
+        '''Count codes (e.g. concept_cd of a chunk of facts) that no ontology has.
+
+        :return: number of unknown codes
+        '''
+        self._learn(vocab)
+        codes = codes[codes >= 0]
+        if len(codes) == 0:
+            return 0  # nor any schemes yet, perhaps; numpy < 1.14 rejects bincount(minlength=0)
+        unknown = codes[~self._known.take(codes)]
+        qty = len(self._schemes)
+        self.checked += np.bincount(self._scheme.take(codes), minlength=qty)
+        self.unknown += np.bincount(self._scheme.take(unknown), minlength=qty)
+        for label in vocab.decode(pd.unique(unknown)):
+            sample = self.samples.setdefault(label.partition(':')[0] + ':', [])
+            if len(sample) < self.sample_size and label not in sample:
+                sample.append(label)
+        return len(unknown)
+
+    def __str__(self) -> str:
+        return '; '.join(
+            '%s %d of %d unknown e.g. %s' % (scheme, self.unknown[ix], self.checked[ix], self.samples[scheme])
+            for scheme, ix in sorted(self._schemes.items())
+            if self.unknown[ix] > 0)
+
+
+_basecodes = {}  # type: Dict[Tuple[str, ...], np.ndarray]
+
+
+def ontology_basecodes(lc: LoggedConnection, tables: List[str]) -> np.ndarray:
+    '''Get the basecodes of some ontology tables, once per process.
+    '''
+    key = tuple(tables)
+    if key not in _basecodes:
+        _basecodes[key] = np.concatenate([
+            read_sql_step('select distinct c_basecode from %s where c_basecode is not null' % table,
+                          lc).c_basecode.values
+            for table in tables])
+    return _basecodes[key]
+
+
+class ConceptCounts(object):
+    '''Distinct concept_cd values of an upload, with fact counts.
+
+    Facts carry concept_cd as vocabulary codes, so counting them
+    across chunks takes just one array of counts, indexed by code:
+
+    >>> vocab = Vocabulary()
+    >>> concepts = ConceptCounts()
+    >>> concepts.add(vocab.encode(np.array(['DRG:1', 'CPT:99213', 'DRG:1'], dtype=object)))
+    >>> concepts.add(vocab.encode(np.array(['ICD9:250.00', None, 'DRG:1'], dtype=object)))
+    >>> len(concepts)
+    3
+    >>> concepts.frame(vocab)
+        concept_cd  fact_qty
+    0    CPT:99213         1
+    1        DRG:1         3
+    2  ICD9:250.00         1
+
+    Codes of modifiers etc. share the vocabulary, but not the counts.
+    '''
+    def __init__(self) -> None:
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int((self.counts > 0).sum())
+
+    def add(self, codes: np.ndarray) -> None:
+        # numpy < 1.14 rejects minlength=0
+        qty = np.bincount(codes[codes >= 0], minlength=max(1, len(self.counts)))
+        if len(qty) > len(self.counts):
+            self.counts = np.append(self.counts, np.zeros(len(qty) - len(self.counts), dtype=np.int64))
+        self.counts += qty
+
+    def frame(self, vocab: Vocabulary) -> pd.DataFrame:
+        seen = np.flatnonzero(self.counts)
+        return (pd.DataFrame(dict(concept_cd=vocab.decode(seen), fact_qty=self.counts.take(seen)),
+                             columns=['concept_cd', 'fact_qty'])
+                .sort_values('concept_cd').reset_index(drop=True))
+
+    @classmethod
+    def table(cls, name: str) -> sqla.Table:
+        return sqla.Table(name, sqla.MetaData(),
+                          sqla.Column('upload_id', sqla.Integer, nullable=False),
+                          sqla.Column('concept_cd', sqla.String(50), nullable=False),
+                          sqla.Column('fact_qty', sqla.Integer, nullable=False))
+
+    def save(self, lc: LoggedConnection, name: str, upload_id: int, vocab: Vocabulary) -> int:
+        '''Insert (upload_id, concept_cd, fact_qty) rows into table name,
+        creating it if need be.
+        '''
+        t = self.table(name)
+        t.create(lc._conn, checkfirst=True)
+        rows = self.frame(vocab)
+        if len(rows) > 0:
+            lc._conn.execute(t.insert(), [dict(upload_id=upload_id, concept_cd=cd, fact_qty=int(qty))
+                                          for cd, qty in zip(rows.concept_cd.values, rows.fact_qty.values)])
+        return len(rows)
+
+
+class FactSummary(object):
+    '''Descriptive statistics of an upload's facts, accumulated chunk by chunk:
+    facts, patients, and encounters by concept prefix, valtype, and
+    start_date year, with min / max / mean of numeric values:
+
+    >>> vocab = Vocabulary()
+    >>> facts = FactBuffer(vocab)
+    >>> facts.append(pd.DataFrame(dict(
+    ...     patient_num=[1, 1, 2, 3], encounter_num=[10, 11, 12, 13], instance_num=0,
+    ...     concept_cd=['DRG:1', 'DRG:2', 'BENE_AGE_CNT:', 'BENE_AGE_CNT:'],
+    ...     valtype_cd=['@', '@', 'N', 'N'], nval_num=[None, None, 67, 80],
+    ...     start_date=pd.to_datetime(['2011-01-01', '2011-02-01', '2011-03-01', '2012-05-05']))))
+    >>> summary = FactSummary()
+    >>> summary.add(facts)
+    >>> summary.add(facts)  # same patients and encounters again
+    >>> summary.frame()[['concept_prefix', 'valtype_cd', 'start_year',
+    ...                  'fact_qty', 'patient_qty', 'encounter_qty', 'nval_mean']]
+      concept_prefix valtype_cd  start_year  fact_qty  patient_qty  encounter_qty  nval_mean
+    0  BENE_AGE_CNT:          N        2011         2            1              1       67.0
+    1  BENE_AGE_CNT:          N        2012         2            1              1       80.0
+    2           DRG:          @        2011         4            1              2        NaN
+
+    Only distinct (group, patient) and (group, encounter) pairs are kept,
+    and they're compacted as they accumulate.
+    Add facts after `FactBuffer.validate`, which drops those with no start_date.
+    '''
+    key = ['concept_prefix', 'valtype_cd', 'start_year']
+    id_columns = [('patient_num', 'patient_qty'), ('encounter_num', 'encounter_qty')]
+
+    def __init__(self) -> None:
+        self.vocab = None  # type: Opt[Vocabulary]
+        self._prefix_of = []  # type: List[int]
+        self._prefixes = OrderedDict()  # type: Dict[str, int]
+        self._aggs = None  # type: Opt[pd.DataFrame]
+        self._ids = {name: [] for name, _qty in self.id_columns}  # type: Dict[str, List[pd.DataFrame]]
+        self._compact_len = {name: 0 for name, _qty in self.id_columns}  # type: Dict[str, int]
+
+    def add(self, facts: 'FactBuffer') -> None:
+        tot = len(facts)
+        if tot == 0:
+            return
+        self.vocab = facts.vocab
+        # prefix of each new vocabulary label
+        for label in facts.vocab.labels(len(self._prefix_of)):
+            prefix = label.partition(':')[0] + ':' if ':' in label else label
+            self._prefix_of.append(self._prefixes.setdefault(prefix, len(self._prefixes)))
+        groups = pd.DataFrame(dict(
+            concept_prefix=np.array(self._prefix_of + [-1], dtype=np.int32).take(facts.concept_cd[:tot]),
+            valtype_cd=facts.valtype_cd[:tot],
+            start_year=facts.start_date[:tot].astype('datetime64[Y]').astype(np.int64) + 1970),
+            columns=self.key)
+
+        nval = groups.assign(nval_num=facts.nval_num[:tot]).groupby(self.key).nval_num
+        aggs = pd.DataFrame(dict(fact_qty=nval.size(), nval_qty=nval.count(),
+                                 nval_min=nval.min(), nval_max=nval.max(),
+                                 nval_mean=nval.mean())).reset_index()
+        self._aggs = aggs if self._aggs is None else combine_summaries(
+            pd.concat([self._aggs, aggs]), self.key)
+
+        for name, _qty in self.id_columns:
+            self._ids[name].append(groups.assign(**{name: getattr(facts, name)[:tot]}).drop_duplicates())
+            if sum(len(part) for part in self._ids[name]) > 2 * self._compact_len[name] + tot:
+                self._compact(name)
+
+    def _compact(self, name: str) -> pd.DataFrame:
+        ids = pd.concat(self._ids[name]).drop_duplicates()
+        self._ids[name] = [ids]
+        self._compact_len[name] = len(ids)
+        return ids
+
+    def frame(self) -> pd.DataFrame:
+        if self._aggs is None or self.vocab is None:
+            return pd.DataFrame(columns=self.key)
+        out = self._aggs.set_index(self.key)
+        for name, qty in self.id_columns:
+            out[qty] = self._compact(name).groupby(self.key).size()
+        out = out.reset_index()
+        prefixes = np.empty(len(self._prefixes) + 1, dtype=object)  # -1: None
+        prefixes[:-1] = list(self._prefixes.keys())
+        out['concept_prefix'] = prefixes.take(out.concept_prefix.values)
+        out['valtype_cd'] = self.vocab.decode(out.valtype_cd.values)
+        return out[self.key + ['fact_qty', 'patient_qty', 'encounter_qty',
+                               'nval_qty', 'nval_min', 'nval_max', 'nval_mean']].sort_values(
+            self.key).reset_index(drop=True)
+
+    def save(self, lc: LoggedConnection, name: str, upload_id: int) -> int:
+        '''Append the summary to table name, with upload_id.
+        '''
+        rows = self.frame()
+        rows.insert(0, 'upload_id', upload_id)
+        rows.to_sql(name, lc._conn, if_exists='append', index=False,
+                    dtype=dict(concept_prefix=sqla.types.String(50),
+                               valtype_cd=sqla.types.String(50)))
+        return len(rows)
+
+
+class VisitRows(object):
+    '''Visit (encounter) rows, accumulated from facts as they're loaded.
+
+    Following the `cms_visit_dimension` view, `enc_code_meta` maps facts
+    to ENC_TYPE codes with ranks; for each encounter, we keep the facts
+    with the best rank:
+
+    >>> enc_types = pd.DataFrame(dict(
+    ...     c_basecode=['NCH_CLM_TYPE_CD:40', 'MEDPAR_YR_NUM:2012', 'REV_CNTR:0450'],
+    ...     valueset_item=['AV', 'IP', 'ED'], pc_rank=[6, 2, 2], ei_bit=[None, 1, 2]))
+    >>> visits = VisitRows(enc_types)
+    >>> vocab = Vocabulary()
+    >>> facts = FactBuffer(vocab)
+    >>> facts.append(pd.DataFrame(dict(
+    ...     patient_num=[1, 1, 1, 2, 2], encounter_num=[10, 10, 10, 20, 20], instance_num=0,
+    ...     concept_cd=['MEDPAR_YR_NUM:2012', 'REV_CNTR:0450', 'DRG:1', 'NCH_CLM_TYPE_CD:40', 'DRG:1'],
+    ...     provider_id='@',
+    ...     start_date=pd.to_datetime(['2012-01-03', '2012-01-02', '2012-01-01', '2012-02-01', '2012-02-02']),
+    ...     end_date=pd.to_datetime(['2012-01-05', None, None, None, None]))))
+    >>> visits.add(facts)
+    >>> visits.frame()[['encounter_num', 'patient_num', 'enc_type', 'ip_bit', 'ed_bit', 'start_date', 'end_date']]
+       encounter_num  patient_num enc_type  ip_bit  ed_bit start_date   end_date
+    0             10            1       IP       1       2 2012-01-02 2012-01-05
+    1             20            2       AV       0       0 2012-02-01        NaT
+
+    Rows from other chunks (and other uploads) merge the same way;
+    see `best_visits`.
+    '''
+    columns = ['encounter_num', 'patient_num', 'pc_rank', 'enc_type', 'ip_bit', 'ed_bit',
+               'start_date', 'end_date', 'provider_id']
+
+    def __init__(self, enc_types: pd.DataFrame) -> None:
+        self._meta = {cd: (rank, item, 0 if pd.isnull(bits) else int(bits))
+                      for cd, item, rank, bits in enc_types[
+                          ['c_basecode', 'valueset_item', 'pc_rank', 'ei_bit']].values}
+        self._items = sorted(set(enc_types.valueset_item))
+        self._rank = []  # type: List[int]
+        self._item = []  # type: List[int]
+        self._bits = []  # type: List[int]
+        self._parts = []  # type: List[pd.DataFrame]
+        self._compact_len = 0
+        self.vocab = None  # type: Opt[Vocabulary]
+
+    def add(self, facts: 'FactBuffer') -> None:
+        tot = len(facts)
+        if tot == 0:
+            return
+        self.vocab = facts.vocab
+        for label in facts.vocab.labels(len(self._rank)):
+            rank, item, bits = self._meta.get(label, (-1, None, 0))
+            self._rank.append(rank)
+            self._item.append(-1 if item is None else self._items.index(item))
+            self._bits.append(bits)
+        codes = facts.concept_cd[:tot]
+        hit = np.flatnonzero(np.array(self._rank + [-1]).take(codes) >= 0)
+        if len(hit) == 0:
+            return
+        codes = codes.take(hit)
+        bits = np.array(self._bits).take(codes)
+        rows = pd.DataFrame(dict(
+            encounter_num=facts.encounter_num.take(hit), patient_num=facts.patient_num.take(hit),
+            pc_rank=np.array(self._rank).take(codes), enc_type=np.array(self._item).take(codes),
+            ip_bit=bits & 1, ed_bit=bits & 2,
+            start_date=facts.start_date.take(hit), end_date=facts.end_date.take(hit),
+            provider_id=facts.provider_id.take(hit)))
+        self._parts.append(best_visits(rows))
+        if sum(len(part) for part in self._parts) > 2 * self._compact_len + len(rows):
+            self._compact()
+
+    def _compact(self) -> pd.DataFrame:
+        visits = best_visits(pd.concat(self._parts)) if len(self._parts) > 1 else self._parts[0]
+        self._parts = [visits]
+        self._compact_len = len(visits)
+        return visits
+
+    def __len__(self) -> int:
+        return len(self._compact()) if self._parts else 0
+
+    def frame(self) -> pd.DataFrame:
+        if not self._parts or self.vocab is None:
+            return pd.DataFrame(columns=self.columns)
+        visits = self._compact().copy()
+        visits['enc_type'] = np.array(self._items, dtype=object).take(visits.enc_type.values)
+        visits['provider_id'] = self.vocab.decode(visits.provider_id.values)
+        return visits
+
+    def save(self, lc: LoggedConnection, name: str, upload_id: int) -> int:
+        '''Append the visit rows to table name, with upload_id.
+        '''
+        rows = self.frame()
+        rows.insert(0, 'upload_id', upload_id)
+        rows.to_sql(name, lc._conn, if_exists='append', index=False,
+                    dtype=dict(enc_type=sqla.types.String(50),
+                               provider_id=sqla.types.String(50)))
+        return len(rows)
+
+
+def best_visits(rows: pd.DataFrame) -> pd.DataFrame:
+    '''Merge visit rows to one per encounter, as in `cms_visit_detail`:
+    of the rows with the best (least) pc_rank, take the earliest
+    start_date, latest end_date, and any of the ED / IP bits.
+
+    >>> rows = pd.DataFrame(dict(
+    ...     encounter_num=[10, 10, 10], patient_num=1, pc_rank=[2, 2, 6], enc_type=['IP', 'ED', 'AV'],
+    ...     ip_bit=[1, 0, 0], ed_bit=[0, 2, 0], provider_id='@',
+    ...     start_date=pd.to_datetime(['2012-01-03', '2012-01-02', '2011-12-01']),
+    ...     end_date=pd.to_datetime(['2012-01-05', None, '2012-02-01'])))
+    >>> best_visits(rows)[['encounter_num', 'pc_rank', 'ip_bit', 'ed_bit', 'start_date', 'end_date']]
+       encounter_num  pc_rank  ip_bit  ed_bit start_date   end_date
+    0             10        2       1       2 2012-01-02 2012-01-05
+    '''
+    best = rows.groupby(['encounter_num', 'patient_num']).pc_rank.transform('min').values
+    g = rows[rows.pc_rank.values == best].groupby(['encounter_num', 'patient_num'])
+    return pd.DataFrame(dict(pc_rank=g.pc_rank.min(), enc_type=g.enc_type.max(),
+                             ip_bit=g.ip_bit.max(), ed_bit=g.ed_bit.max(),
+                             start_date=g.start_date.min(), end_date=g.end_date.max(),
+                             provider_id=g.provider_id.min()),
+                        columns=VisitRows.columns[2:]).reset_index()
+
+
+def combine_summaries(data: pd.DataFrame, key: List[str]) -> pd.DataFrame:
+    '''Combine descriptive statistics; e.g. of the uploads of the bene_id chunks of a table.
+
+    >>> per_upload = pd.DataFrame(dict(
+    ...     upload_id=[1, 2, 2], concept_prefix=['BENE_AGE_CNT:', 'BENE_AGE_CNT:', 'DRG:'],
+    ...     fact_qty=[2, 6, 4], patient_qty=[2, 5, 3], nval_qty=[2, 6, 0],
+    ...     nval_min=[60, 67, None], nval_max=[80, 90, None], nval_mean=[70.0, 80.0, None]))
+    >>> combine_summaries(per_upload, ['concept_prefix'])
+      concept_prefix  fact_qty  patient_qty  nval_qty  nval_min  nval_max  nval_mean
+    0  BENE_AGE_CNT:         8            7         8      60.0      90.0       77.5
+    1           DRG:         4            3         0       NaN       NaN        NaN
+
+    Patient and encounter counts add up, so they're exact only across
+    uploads with distinct patients (encounters), such as bene_id chunks.
+    '''
+    qtys = [name for name in ['fact_qty', 'patient_qty', 'encounter_qty', 'nval_qty']
+            if name in data.columns]
+    g = data.assign(nval_total=data.nval_mean.fillna(0) * data.nval_qty).groupby(key)
+    out = g[qtys + ['nval_total']].sum()
+    out['nval_min'] = g.nval_min.min()
+    out['nval_max'] = g.nval_max.max()
+    out['nval_mean'] = (out.nval_total / out.nval_qty).where(out.nval_qty > 0)
+    return out.drop('nval_total', axis=1).reset_index()
+
+
+class ChunkSizer(object):
+    '''Adapt the number of source rows per chunk to a memory budget.
+
+    Facts per source row vary a lot by table: a few dozen for
+    BCARRIER_CLAIMS vs. hundreds for MEDPAR_ALL. So rather than
+    one fixed chunk size, we measure bytes per source row (source
+    records, intermediate fact frames, buffered facts) as we go
+    and size the next chunk to fit the budget:
+
+    >>> sizer = ChunkSizer(budget=10 * 2 ** 20, size=1000)
+    >>> sizer.observe_source(rows=1000, source_bytes=500 * 1000)
+    >>> sizer.observe_facts(fact_qty=28000, fact_bytes=28000 * 250)
+    >>> sizer.row_bytes, sizer.facts_per_row, sizer.size
+    (7500.0, 28.0, 1398)
+
+    To stay stable in the face of noisy measurements, we smooth them
+    and at most double the size from one chunk to the next:
+
+    >>> sizer.observe_source(rows=1398, source_bytes=500 * 1398)
+    >>> sizer.observe_facts(fact_qty=1398 * 2, fact_bytes=1398 * 2 * 250)
+    >>> sizer.row_bytes, sizer.facts_per_row, sizer.size
+    (4250.0, 15.0, 2467)
+
+    Measurements of source and facts are matched up in order,
+    so source chunks may be fetched ahead of the facts from them.
+    '''
+    min_size = 100
+    max_growth = 2
+    smoothing = 0.5
+
+    def __init__(self, budget: int, size: int) -> None:
+        self.budget = budget
+        self.size = size
+        self.row_bytes = None  # type: Opt[float]
+        self.facts_per_row = None  # type: Opt[float]
+        self._sources = deque()  # type: Any
+
+    def observe_source(self, rows: int, source_bytes: int) -> None:
+        self._sources.append((rows, source_bytes))
+
+    def observe_facts(self, fact_qty: int, fact_bytes: int) -> None:
+        rows, source_bytes = self._sources.popleft()
+        if rows == 0:
+            return
+        self.row_bytes = self._smooth(self.row_bytes, (source_bytes + fact_bytes) / rows)
+        self.facts_per_row = self._smooth(self.facts_per_row, fact_qty / rows)
+        fit = int(self.budget / self.row_bytes)
+        self.size = max(self.min_size, min(fit, self.size * self.max_growth))
+
+    @classmethod
+    def _smooth(cls, prev: Opt[float], current: float) -> float:
+        return current if prev is None else cls.smoothing * current + (1 - cls.smoothing) * prev
+
+
+def fetch_sized(result: ResultProxy, size: Callable[[], int]) -> Iterator[pd.DataFrame]:
+    '''Fetch query results in chunks, as `pd.read_sql` does,
+    but asking `size()` for the size of each chunk.
+
+    >>> db = sqla.create_engine('sqlite://')
+    >>> q = 'select 1 x, 2.5 y union all select 3, null union all select 5, 6'
+    >>> [len(chunk) for chunk in fetch_sized(db.execute(q), lambda: 2)]
+    [2, 1]
+    '''
+    columns = result.keys()
+    while 1:
+        rows = result.fetchmany(size())
+        if not rows:
+            break
+        yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def fetch_columns(result: ResultProxy, size: Callable[[], int],
+                  types: Dict[str, sqla.types.TypeEngine],
+                  arraysize: int=5000) -> Iterator[pd.DataFrame]:
+    '''Fetch query results in chunks straight from the DB-API cursor,
+    converting each column by its (reflected) type rather than
+    building object columns and inferring their dtypes:
+
+    >>> import datetime
+    >>> db = sqla.create_engine('sqlite://')
+    >>> t = sqla.Table('rif', sqla.MetaData(),
+    ...                sqla.Column('bene_id', sqla.String(15)), sqla.Column('qty', sqla.Integer),
+    ...                sqla.Column('amt', sqla.Numeric(10, 2)), sqla.Column('dt', sqla.Date))
+    >>> t.create(db)
+    >>> _ = db.execute(t.insert(), [
+    ...     dict(bene_id='b1', qty=1, amt=2.5, dt=datetime.date(2011, 1, 1)),
+    ...     dict(bene_id='b2', qty=None, amt=None, dt=None),
+    ...     dict(bene_id='b3', qty=3, amt=4, dt=datetime.date(2011, 3, 1))])
+    >>> q = t.select()
+    >>> chunks = list(fetch_columns(db.execute(q), lambda: 2, {c.name: c.type for c in q.columns}))
+    >>> [len(chunk) for chunk in chunks]
+    [2, 1]
+    >>> chunks[0].dtypes.astype(str).to_dict()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'bene_id': 'object', 'qty': 'float64', 'amt': 'float64', 'dt': 'datetime64[ns]'}
+    >>> chunks[1]
+      bene_id  qty  amt         dt
+    0      b3    3  4.0 2011-03-01
+
+    Integer columns are int64 where they have no nulls, as with `pd.read_sql`.
+
+    Sentinel dates such as 9999-12-31 don't fit in datetime64[ns];
+    rather than let them wrap around, we keep a chunk's dates as
+    objects if any are out of range, and log how many were:
+
+    >>> _ = db.execute(t.insert(), [dict(bene_id='b4', dt=datetime.date(9999, 12, 31))])
+    >>> chunk = list(fetch_columns(db.execute(q), lambda: 2, {c.name: c.type for c in q.columns}))[-1]
+    >>> chunk.dt.dtype, chunk.dt.iloc[-1][:10]
+    (dtype('O'), '9999-12-31')
+
+    :param size: as in `fetch_sized`
+    :param types: by column name; others are left as objects
+    :param arraysize: DB-API cursor arraysize, i.e. rows per round trip
+    '''
+    names = list(result.keys())
+    convert = [_column_converter(types.get(name)) for name in names]
+    out_of_range = Counter()  # type: Counter
+    cursor = result.cursor
+    cursor.arraysize = arraysize
+    try:
+        while 1:
+            rows = cursor.fetchmany(size())
+            if not rows:
+                break
+            cols = list(zip(*rows))
+            del rows
+            data = OrderedDict()  # type: Dict[str, np.ndarray]
+            for name, conv, col in zip(names, convert, cols):
+                if conv is None:
+                    data[name], out_of_range[name] = _date_column(col)
+                else:
+                    data[name] = conv(col)
+            yield pd.DataFrame(data, columns=names)
+        for name, qty in sorted(out_of_range.items()):
+            if qty:
+                log.warning('%d %s values out of datetime64 range; kept as objects', qty, name)
+    finally:
+        result.close()  # type: ignore
+
+
+def _column_converter(ty: Opt[sqla.types.TypeEngine]) -> Opt[Callable[[Tuple[Any, ...]], np.ndarray]]:
+    '''Get a conversion to numpy by column type; None for dates (see `_date_column`).
+    '''
+    if isinstance(ty, (sqla.types.Date, sqla.types.DateTime)):
+        return None
+    if isinstance(ty, sqla.types.Integer) or (isinstance(ty, sqla.types.Numeric) and ty.scale == 0):
+        return _int_column
+    if isinstance(ty, sqla.types.Numeric):
+        return lambda col: np.array(col, dtype=float)  # None -> nan
+    return lambda col: np.array(col, dtype=object)
+
+
+def _date_column(col: Tuple[Any, ...]) -> Tuple[np.ndarray, int]:
+    '''Convert to datetime64[ns] (None -> NaT), unless some values are
+    out of range (or otherwise not dates), in which case keep objects.
+
+    :return: values and how many were out of range
+    '''
+    values = np.array(col, dtype=object)
+    dates = np.asarray(pd.to_datetime(values, errors='coerce'))
+    out_of_range = int((pd.isnull(dates) & ~pd.isnull(values)).sum())
+    return (values if out_of_range else dates), out_of_range
+
+
+def _int_column(col: Tuple[Any, ...]) -> np.ndarray:
+    try:
+        return np.array(col, dtype=np.int64)
+    except TypeError:  # None
+        return np.array(col, dtype=float)
+
+
+class PivotPlan(object):
+    '''How to pivot records of a CMS RIF table, worked out once per table.
+
+    Facts from each chunk of records are pivoted using the same plan,
+    leaving only data transformation to do per chunk:
+
+    >>> rif_data, col_info, simple_cols = _RIFTestData.build(MEDPAR_Upload)
+    >>> plan = MEDPAR_Upload.pivot_plan(col_info)
+    >>> plan.id_vars
+    ['bene_id', 'medpar_id', 'admsn_dt', 'dschrg_dt', 'ltst_clm_acrtn_dt', 'org_npi_num']
+    >>> [(name, valtype.value, scheme) for name, valtype, scheme in plan.fact_cols
+    ...  if name in ['drg_cd', 'bene_age_cnt']]
+    [('drg_cd', '@', 'MSDRG:'), ('bene_age_cnt', 'N', 'BENE_AGE_CNT:')]
+
+    Diagnosis and procedure columns are grouped rather than pivoted:
+
+    >>> len(plan.simple_cols), len(plan.dx_groups), len(plan.px_groups)
+    (71, 38, 25)
+    >>> MEDPAR_Upload.pivot_plan(col_info) is plan
+    True
+    '''
+    def __init__(self, id_vars: List[str], simple_cols: pd.DataFrame,
+                 scheme_override: Dict[str, str],
+                 dx_groups: Opt[pd.DataFrame]=None,
+                 px_groups: Opt[pd.DataFrame]=None) -> None:
+        self.id_vars = id_vars
+        self.simple_cols = simple_cols
+        self.dx_groups = dx_groups
+        self.px_groups = px_groups
+        # (column_name, valtype, concept scheme) in order of Valtype
+        self.fact_cols = [
+            (name, valtype, scheme_override.get(name, name).upper() + ':')
+            for valtype in Valtype
+            for name in simple_cols[simple_cols.valtype_cd == valtype.value].column_name
+        ]  # type: List[Tuple[str, Valtype, str]]
+
+
+_col_data = {}  # type: Dict[type, pd.DataFrame]
+_pivot_plans = {}  # type: Dict[Tuple[type, Tuple[str, ...], Tuple[str, ...]], PivotPlan]
 
 
 class CMSRIFUpload(MedparMapped, CMSVariables):
@@ -849,14 +2635,45 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
     group_qty = IntParam(significant=False, default=-1)
 
     chunk_size = IntParam(default=10000, significant=False)
+    # adapt chunk_size to keep the chunks in memory at once (read ahead,
+    # in workers, writing behind) within this much memory (0: don't)
+    chunk_budget_mb = IntParam(default=0, significant=False)
+    # count source rows (a second scan) for progress, rather than estimate them
+    exact_rowcount = BoolParam(default=False, significant=False)
+    # fetch straight from the DB-API cursor into typed columns, arraysize rows
+    # per round trip, rather than via pd.read_sql
+    columnar = BoolParam(default=False, significant=False)
+    arraysize = IntParam(default=5000, significant=False)
+    # read this many sub-ranges of our bene_ids at once, each on its own
+    # connection; needs a finer bene_chunks survey; see sub_ranges.
+    # Rows are then numbered in bene_id order, at the cost of a sort; see numbered
+    read_parallelism = IntParam(default=1, significant=False)
+    # pivot chunks in this many worker processes (0: in this process)
+    workers = IntParam(default=0, significant=False)
+    # load only the latest version of each claim; see claim_key
+    latest_only = BoolParam(default=False, significant=False)
+    # re-pivot only these columns / concept prefixes into the facts
+    # of an earlier upload, rather than reloading everything after
+    # a change to design_version; see repivot_targets
+    repivot = StrParam(default='', significant=False)
+    # design_version of the upload whose facts we replace
+    repivot_version = IntParam(default=0, significant=False)
+    # where its facts are (default: its observation_fact_N)
+    repivot_table = StrParam(default='', significant=False)
+    # star schema the earlier upload was migrated to, if it was, so we
+    # replace the facts there too ('': not yet; MigrateUpload will copy them)
+    repivot_star = StrParam(default='', significant=False)
     # label doesn't overlap with RIF columns
     src_ix = sqla.literal_column('rownum', type_=sqla.types.Integer).label('src_ix')
-    chunk_rowcount = 1  # updated to useful value in `chunks()` method
+    chunk_rowcount = 1  # estimated (or counted) in `chunks()` method
 
     table_name = 'PLACEHOLDER'
 
     obs_id_vars = ['patient_ide', 'encounter_ide', 'start_date', 'end_date', 'update_date', 'provider_id']
     obs_value_cols = ['update_date', 'start_date', 'end_date']
+    # columns that identify a claim across versions, where update_date
+    # distinguishes the versions
+    claim_key = []  # type: List[str]
 
     @property
     def label(self) -> str:
@@ -875,10 +2692,36 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
         return self.source.table_details(lc, [self.table_name])
 
     def source_query(self, meta: sqla.MetaData) -> sqla.sql.expression.Select:
-        # ISSUE: order_by(t.c.bene_id)?
         t = meta.tables[self.qualified_name()].alias('rif')
-        return (sqla.select([self.src_ix] + self.active_source_cols(t))  # type: ignore
-                .where(t.c.bene_id.between(self.bene_id_first, self.bene_id_last)))
+        return self.numbered(self.bene_sampled(
+            sqla.select(self.source_cols(t))
+            .where(t.c.bene_id.between(self.bene_id_first, self.bene_id_last)), t.c.bene_id), t)
+
+    def numbered(self, q: sqla.sql.expression.Select, t: sqla.Table) -> sqla.sql.expression.Select:
+        '''Number the rows of q (src_ix).
+
+        To read in parallel, we number rows in order of bene_id (then
+        rowid), so that reading sub-ranges of bene_ids one after another
+        numbers them the same as reading the whole range; see
+        `read_ordered`. Oracle assigns rownum before order by, so we
+        order in a subquery.
+
+        Otherwise, rows are numbered as they come, without the cost of
+        a sort (and as in uploads before read_parallelism).
+        '''
+        if self.read_parallelism <= 1:
+            return q.with_only_columns([self.src_ix] + list(q.inner_columns))  # type: ignore
+        ordered = q.order_by(t.c.bene_id, sqla.literal_column(t.name + '.rowid')).alias('ordered')  # type: ignore
+        return sqla.select([self.src_ix] + list(ordered.c))  # type: ignore
+
+    def source_cols(self, t: sqla.Table) -> List[sqla.Column]:
+        cols = self.active_source_cols(t)
+        if not self.repivot:
+            return cols
+        # Skip the columns we're not re-pivoting; keep the ones we need to map facts.
+        columns, _prefixes = self.repivot_targets(self.repivot)
+        keep = set(self.i2b2_map.values()) | set(self.claim_key) | set(columns)
+        return [c for c in cols if c.name in keep]
 
     @classmethod
     def active_source_cols(cls, t: sqla.Table) -> List[sqla.Column]:
@@ -887,13 +2730,190 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
 
     @classmethod
     def active_col_data(cls) -> pd.DataFrame:
-        info = CMSVariables.active_columns(
-            cls.table_name, extras=cls.i2b2_map.values())
-        info.column_name = info.column_name.str.lower()
-        return info
+        info = _col_data.get(cls)
+        if info is None:
+            info = CMSVariables.active_columns(
+                cls.table_name, extras=cls.i2b2_map.values()).copy()
+            info.column_name = info.column_name.str.lower()
+            _col_data[cls] = info
+        return info.copy()
+
+    @classmethod
+    def pivot_plan(cls, cols: pd.DataFrame) -> 'PivotPlan':
+        """Get the plan for pivoting records with the given columns.
+
+        Plans are compiled once per task class (and set of columns).
+
+        :param cols: with column_name, valtype_cd, in the order of the
+                     source query
+        """
+        key = (cls, tuple(cols.column_name), tuple(cols.valtype_cd.astype(str)))
+        plan = _pivot_plans.get(key)
+        if plan is None:
+            plan = _pivot_plans[key] = cls.compile_plan(cols)
+        return plan
+
+    @classmethod
+    def compile_plan(cls, cols: pd.DataFrame) -> 'PivotPlan':
+        return PivotPlan(cls.mapped_id_vars(), cols, cls.concept_scheme_override)
+
+    @classmethod
+    def mapped_id_vars(cls) -> List[str]:
+        return _no_dups([cls.i2b2_map[v] for v in cls.obs_id_vars if v in cls.i2b2_map])
+
+    @classmethod
+    def repivot_targets(cls, spec: str) -> Tuple[List[str], List[str]]:
+        """Which columns to re-pivot and which concept_cd prefixes to replace.
+
+        Each comma-separated item of spec is a column, a column with
+        the prefix its facts had in the earlier upload, or a concept
+        prefix, selecting the columns that (now) pivot to that scheme:
+
+        >>> MEDPAR_Upload.repivot_targets('drg_cd=DRG_CD:, BENE_AGE_CNT:')
+        (['drg_cd', 'bene_age_cnt'], ['MSDRG:', 'DRG_CD:', 'BENE_AGE_CNT:'])
+
+        Diagnosis and procedure columns are pivoted in groups, with
+        prefixes shared across columns, so they can't be re-pivoted
+        one by one:
+
+        >>> MEDPAR_Upload.repivot_targets('dgns_1_cd')
+        Traceback (most recent call last):
+          ...
+        ValueError: cannot re-pivot dgns_1_cd of medpar_all
+        """
+        col_info = cls.active_col_data()
+        simple = col_info[~col_info.Status.isnull() &
+                          ~col_info.column_name.isin(cls.i2b2_map.values()) &
+                          col_info.dxpx.isnull()].column_name
+
+        def scheme(name: str) -> str:
+            return cls.concept_scheme_override.get(name, name).upper() + ':'
+
+        columns = []  # type: List[str]
+        prefixes = []  # type: List[str]
+        for item in [item.strip() for item in spec.split(',') if item.strip()]:
+            name, _eq, old = item.partition('=')
+            if not _eq and item.endswith(':'):
+                selected = [name for name in simple if scheme(name) == item]
+                if not selected:
+                    raise ValueError('no %s columns with prefix %s' % (cls.table_name, item))
+                columns += selected
+                prefixes.append(item)
+            elif name in simple.values:
+                columns.append(name)
+                prefixes += [scheme(name)] + ([old] if old else [])
+            else:
+                raise ValueError('cannot re-pivot %s of %s' % (name, cls.table_name))
+        return _no_dups(columns), _no_dups(prefixes)
+
+    @property
+    def transform_name(self) -> str:
+        # Don't let a re-pivot pass for a complete load at this design_version.
+        name = super().transform_name
+        if not self.repivot:
+            return name
+        return '%s repivot %s of v%d' % (name, self.repivot, self.repivot_version)
+
+    def load(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int, result: Params) -> None:
+        DataLoadTask.load(self, lc, upload, upload_id, result)
+        if self.repivot:
+            self.swap_repivot(lc, upload, upload_id, result)
+            if self.repivot_star:
+                self.migrate_repivot(lc, upload, upload_id)
+
+    def fact_target(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int,
+                    fact_proto: sqla.Table, result: Params) -> Tuple[sqla.Table, int]:
+        """When re-pivoting, stage the new facts, under the prior upload_id,
+        in a table of our own; see swap_repivot.
+        """
+        if not self.repivot:
+            return DataLoadTask.fact_target(self, lc, upload, upload_id, fact_proto, result)
+        prior = self.prior_upload(lc, upload)
+        staged, _ = DataLoadTask.fact_target(self, lc, upload, upload_id, fact_proto, result)
+        return staged, prior
+
+    def swap_repivot(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int,
+                     result: Params) -> None:
+        """Replace the re-pivoted facts of the prior upload with the staged ones.
+
+        The delete and insert go in one transaction, so a failed load
+        leaves the prior upload as it was.
+        """
+        [fact_proto] = self.project.table_details(lc, ['observation_fact']).tables.values()
+        prior = self.prior_upload(lc, upload)
+        fact_table = self.repivot_fact_table(fact_proto, prior)
+        staged = sqla.Table('observation_fact_%d' % upload_id, sqla.MetaData(),
+                            *[c.copy() for c in fact_proto.columns])
+        _columns, prefixes = self.repivot_targets(self.repivot)
+        with lc.log.step('UP#%(upload_id)d: %(event)s %(prefixes)s facts of UP#%(prior)d in %(table)s',
+                         dict(event='replace', upload_id=upload_id, prefixes=prefixes,
+                              prior=prior, table=fact_table.name)) as step:
+            with lc._conn.begin():
+                deleted = cast(int, lc.execute(
+                    fact_table.delete().where(self.repivoted_facts(fact_table, prior))).rowcount)
+                inserted = lc.execute(fact_table.insert().from_select(
+                    [c.name for c in staged.columns], sqla.select(list(staged.columns)))).rowcount
+            step.argobj.update(dict(deleted=deleted, inserted=inserted))
+            step.msg_parts.append(': -%(deleted)d +%(inserted)d')
+        staged.drop(lc._conn)
+        result[upload.table.c.deleted_record.name] = deleted
+
+    def repivot_fact_table(self, fact_proto: sqla.Table, prior: int) -> sqla.Table:
+        schema, _dot, name = (self.repivot_table or 'observation_fact_%d' % prior).rpartition('.')
+        return sqla.Table(name, sqla.MetaData(),
+                          *[c.copy() for c in fact_proto.columns],
+                          schema=schema or None)
+
+    def repivoted_facts(self, fact_table: sqla.Table, prior: int) -> sqla.sql.elements.ClauseElement:
+        '''Condition for the facts of the prior upload that we re-pivot.
+        '''
+        _columns, prefixes = self.repivot_targets(self.repivot)
+        concept_cd = fact_table.c.concept_cd
+        # substr rather than like, since _ in DRG_CD: would match any character
+        return sqla.and_(fact_table.c.upload_id == prior,  # type: ignore
+                         sqla.or_(*[sqla.func.substr(concept_cd, 1, len(prefix)) == prefix
+                                    for prefix in prefixes]))
+
+    def migrate_repivot(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int) -> None:
+        '''Replace the re-pivoted facts of the prior upload in repivot_star,
+        where MigrateUpload copied them before we re-pivoted.
+
+        The new upload has no observation_fact_N of its own to migrate.
+        '''
+        [fact_proto] = self.project.table_details(lc, ['observation_fact']).tables.values()
+        prior = self.prior_upload(lc, upload)
+        work_t = self.repivot_fact_table(fact_proto, prior)
+        star_t = sqla.Table('observation_fact', sqla.MetaData(),
+                            *[c.copy() for c in fact_proto.columns],
+                            schema=self.repivot_star)
+        with lc.log.step('UP#%(upload_id)d: %(event)s facts of UP#%(prior)d into %(star)s',
+                         dict(event='migrate re-pivoted', upload_id=upload_id, prior=prior,
+                              star=self.repivot_star)) as step:
+            with lc._conn.begin():
+                deleted = lc.execute(star_t.delete().where(self.repivoted_facts(star_t, prior))).rowcount
+                inserted = lc.execute(star_t.insert().from_select(
+                    [c.name for c in work_t.columns],
+                    sqla.select(list(work_t.columns)).where(self.repivoted_facts(work_t, prior)))).rowcount
+            step.argobj.update(dict(deleted=deleted, inserted=inserted))
+            step.msg_parts.append(': -%(deleted)d +%(inserted)d')
+
+    def prior_upload(self, lc: LoggedConnection, upload: 'UploadTarget') -> int:
+        """Find the latest complete upload of these bene_ids at repivot_version.
+        """
+        if not self.repivot_version or 'design_version' not in self.get_param_names():
+            raise ValueError('repivot requires repivot_version (design_version of the earlier upload)')
+        transform_name = self.clone(design_version=self.repivot_version, repivot='').transform_name
+        up_t = upload.table
+        upload_id = lc.scalar(sqla.select([sqla.func.max(up_t.c.upload_id)])
+                              .where(sqla.and_(up_t.c.transform_name == transform_name,
+                                               up_t.c.load_status == 'OK')))
+        if upload_id is None:
+            raise ValueError('no complete upload to re-pivot: %s' % transform_name)
+        return int(upload_id)
 
     def chunks(self, lc: LoggedConnection,
-               chunk_size: int=1000) -> pd.DataFrame:
+               chunk_size: int=1000,
+               sizer: Opt['ChunkSizer']=None) -> Iterator[pd.DataFrame]:
         '''Get data from `source_query` in chunks.
 
         .. note:: Here we use "chunk" in the pandas sense of
@@ -901,15 +2921,96 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
                   we're breaking up covers a "chunk" in the sense
                   of breaking up the CMS RIF data into
                   chunks of beneficiaries.
+
+        :param sizer: if given, the size of each chunk is `sizer.size`
+                      at the time it's fetched.
         '''
         params = dict(bene_id_first=self.bene_id_first,
-                      bene_id_last=self.bene_id_last)
+                      bene_id_last=self.bene_id_last)  # type: Params
         meta = self.table_info(lc)
         q = self.source_query(meta)
         log_plan(lc, event='get chunk', query=q, params=params)
         # How many rows for this whole chunk of beneficiaries?
-        self.chunk_rowcount = lc.scalar(sqla.select([sqla.func.count()]).select_from(q))
-        return pd.read_sql(q, lc._conn, params=params, chunksize=chunk_size)
+        if self.exact_rowcount:
+            self.chunk_rowcount = lc.scalar(sqla.select([sqla.func.count()]).select_from(q))
+        else:
+            self.chunk_rowcount = self.estimate_rowcount(lc)
+        if self.read_parallelism > 1:
+            return self._read_sub_ranges(lc, meta, chunk_size, sizer)
+        return self._fetch(lc, q, params, chunk_size, sizer)
+
+    def _fetch(self, lc: LoggedConnection, q: sqla.sql.expression.Select, params: Params,
+               chunk_size: int, sizer: Opt['ChunkSizer']) -> Iterator[pd.DataFrame]:
+        if sizer is None:
+            if not self.columnar:
+                return cast(Iterator[pd.DataFrame],
+                            pd.read_sql(q, lc._conn, params=params, chunksize=chunk_size))
+            size = lambda: chunk_size  # type: Callable[[], int]
+        else:
+            sized = sizer
+            size = lambda: sized.size
+        if self.columnar:
+            return fetch_columns(lc._conn.execute(q, params), size,
+                                 {col.name: col.type for col in q.columns}, self.arraysize)
+        return fetch_sized(lc._conn.execute(q, params), size)
+
+    def _read_sub_ranges(self, lc: LoggedConnection, meta: sqla.MetaData,
+                         chunk_size: int, sizer: Opt['ChunkSizer']) -> Iterator[pd.DataFrame]:
+        '''Read sub-ranges of our bene_ids concurrently, in order;
+        see `read_ordered`.
+        '''
+        def read(first: int, last: int) -> Iterator[pd.DataFrame]:
+            part = self.clone(bene_id_first=first, bene_id_last=last)
+            with self.connection('read bene_ids %d..%d' % (first, last)) as rc:
+                yield from part._fetch(rc, part.source_query(meta),
+                                       dict(bene_id_first=first, bene_id_last=last),
+                                       chunk_size, sizer)
+
+        return read_ordered(lc.log, [read(first, last) for first, last in self.sub_ranges(lc)],
+                            'select from ' + self.qualified_name(), self.src_ix.name)
+
+    def sub_ranges(self, lc: LoggedConnection) -> List[Tuple[int, int]]:
+        '''Split our bene_ids into (up to) read_parallelism sub-ranges
+        at the boundaries of a finer `bene_chunks` survey (the one with
+        the most chunks), rather than scan our range for quantiles.
+
+        Lacking a finer survey, we read the whole range at once.
+        '''
+        ends = read_sql_step('''
+            select to_number(bene_id_last) bene_id_last from bene_chunks
+            where chunk_qty = (select max(chunk_qty) from bene_chunks)
+              and to_number(bene_id_last) >= :bene_id_first
+              and to_number(bene_id_last) < :bene_id_last
+            order by 1
+            ''', lc, params=dict(bene_id_first=self.bene_id_first, bene_id_last=self.bene_id_last))
+        ranges = split_range(self.bene_id_first, self.bene_id_last,
+                             survey_cuts([int(end) for end in ends.bene_id_last], self.read_parallelism))
+        if len(ranges) < self.read_parallelism:
+            lc.log.warning('%(event)s: only %(qty)d; survey more bene_chunks for read_parallelism %(parts)d',
+                           dict(event='read sub-ranges', qty=len(ranges), parts=self.read_parallelism))
+        lc.log.info('%(event)s: %(ranges)s', dict(event='read sub-ranges', ranges=ranges))
+        return ranges
+
+    def estimate_rowcount(self, lc: LoggedConnection) -> int:
+        '''Estimate the rows for our bene_ids without scanning them:
+        the table's share of the optimizer's num_rows, by bene_id_qty
+        out of all the bene_ids in the `bene_chunks` survey.
+
+        Lacking statistics or a survey, we start at 1;
+        `_input_progress` refines the estimate as rows arrive.
+        '''
+        if self.bene_id_qty < 1:
+            return 1
+        params = dict(bene_id_qty=self.bene_id_qty, sample_pct=min(self.bene_sample_pct, 100),
+                      chunk_qty=BeneIdSurvey().bene_chunks,
+                      owner=self.source.cms_rif, table_name=self.table_name)  # type: Params
+        est = lc.scalar('''
+            select t.num_rows * :bene_id_qty / nullif(s.bene_id_qty, 0) * :sample_pct / 100
+            from all_tables t
+               , (select sum(bene_id_qty) bene_id_qty from bene_chunks where chunk_qty = :chunk_qty) s
+            where t.owner = upper(:owner) and t.table_name = upper(:table_name)
+            ''', params=params)
+        return max(1, int(est or 0))
 
     def column_data(self, lc: LoggedConnection) -> pd.DataFrame:
         meta = self.table_info(lc)
@@ -921,10 +3022,20 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
                              for col in q.columns
                              if col.name != self.src_ix.name])
 
-    def obs_data(self, lc: LoggedConnection, upload_id: int) -> Iterator[Tuple[pd.DataFrame, float]]:
-        cols = self.column_properties(self.column_data(lc))
-        chunks = self.chunks(lc, chunk_size=self.chunk_size)
-        subtot_in = 0
+    @property
+    def chunks_in_flight(self) -> int:
+        '''How many chunks may be in memory at once, sharing chunk_budget_mb:
+        one in hand, plus one read ahead and one writing behind (pipeline),
+        2 per pivot worker, and 2 per sub-range reader.
+        '''
+        return (1 + (2 if self.pipeline else 0) + 2 * self.workers +
+                (2 * self.read_parallelism if self.read_parallelism > 1 else 0))
+
+    def obs_data(self, lc: LoggedConnection, upload_id: int) -> Iterator[Tuple[FactBuffer, float]]:
+        plan = self.pivot_plan(self.column_properties(self.column_data(lc)))
+        sizer = (ChunkSizer(self.chunk_budget_mb * 2 ** 20 // self.chunks_in_flight, self.chunk_size)
+                 if self.chunk_budget_mb > 0 else None)
+        chunks = self.chunks(lc, chunk_size=self.chunk_size, sizer=sizer)
 
         bene_range = (self.bene_id_first, self.bene_id_last)
         with lc.log.step('%(event)s %(bene_range)s',
@@ -936,7 +3047,43 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
             map_step.argobj.update(emap_len=len(emap))
             map_step.msg_parts.append(' emap: %(emap_len)d')
 
-        [fact_t] = self.project.table_details(lc, ['observation_fact']).tables.values()
+        latest = self.latest_versions(lc) if self.latest_only and self.claim_key else None
+
+        vocab = Vocabulary()
+        facts = FactBuffer(vocab)
+        inputs = self._input_chunks(lc, upload_id, chunks, sizer, latest)
+        if self.workers > 0:
+            pivoted = self._pivot_in_workers(lc, inputs, plan, pmap, emap)
+        else:
+            pivoted = ((self.pivot_chunk(lc.log, data, plan, pmap, emap, vocab), None, pct_in)
+                       for data, pct_in in inputs)
+
+        for parts, labels, pct_in in pivoted:
+            # Buffer each part of the facts as we go, rather than building one big frame.
+            part_bytes = 0
+            for part in parts:
+                part_bytes = max(part_bytes, part.memory_usage(deep=True).sum())
+                facts.append(part, labels)
+            del parts
+            if sizer is not None:
+                sizer.observe_facts(len(facts), part_bytes + len(facts) * FactBuffer.row_bytes())
+                lc.log.info('%(event)s: %(row_bytes)d bytes, %(facts_per_row)0.1f facts per row;'
+                            ' next: %(chunk_size)d rows',
+                            dict(event='chunk size', row_bytes=sizer.row_bytes,
+                                 facts_per_row=sizer.facts_per_row, chunk_size=sizer.size))
+            if len(facts) == 0:
+                continue
+            lc.log.info('%d facts; vocabulary: %d', len(facts), len(vocab))
+            yield facts, pct_in
+
+    def _input_chunks(self, lc: LoggedConnection, upload_id: int,
+                      chunks: Iterator[pd.DataFrame],
+                      sizer: Opt['ChunkSizer']=None,
+                      latest: Opt[pd.Series]=None) -> Iterator[Tuple[pd.DataFrame, float]]:
+        if self.pipeline:
+            chunks = read_ahead(lc.log, chunks, 'select from ' + self.qualified_name())
+        subtot_in = 0
+        superseded = 0
         while 1:
             with lc.log.step('UP#%(upload_id)d: %(event)s from %(source_table)s',
                              dict(event='select', upload_id=upload_id,
@@ -946,33 +3093,113 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
                 except StopIteration:
                     break
                 subtot_in, pct_in = self._input_progress(data, subtot_in, s1)
-
-            obs, simple_cols = self.custom_obs(lc, data, cols)
-
-            with lc.log.step('%(event)s from %(records)d %(source_table)s records',
-                             dict(event='pivot facts', records=len(data),
-                                  source_table=self.qualified_name())) as pivot_step:
-                for valtype in Valtype:
-                    obs_v = self.pivot_valtype(valtype, data, self.table_name, simple_cols)
-                    if len(obs_v) > 0:
-                        obs = obs_v if obs is None else obs.append(obs_v)
-                if obs is None:
-                    continue
-                pivot_step.argobj.update(dict(obs_len=len(obs)))
-                pivot_step.msg_parts.append(' %(obs_len)d total observations')
-
-                mapped = self.with_mapping(obs, pmap, emap)
-                lc.log.info('after mapping by %s: %d',
-                            'medpar_id' if 'medpar_id' in obs.columns.values else 'bene_id and start_date',
-                            len(mapped))
-            obs_fact = self.with_admin(mapped, upload_id, lc, fact_t)
-
-            yield obs_fact, pct_in
+                if latest is not None:
+                    data, qty = drop_superseded(data, latest, self.claim_key,
+                                                self.i2b2_map['update_date'])
+                    superseded += qty
+                    s1.argobj.update(superseded=superseded)
+                    s1.msg_parts.append(' (superseded versions so far: %(superseded)d)')
+                if sizer is not None:
+                    sizer.observe_source(len(data), data.memory_usage(deep=True).sum())
+            yield data, pct_in
+        if latest is not None:
+            lc.log.info('UP#%(upload_id)d: dropped %(superseded)d superseded claim versions',
+                        dict(upload_id=upload_id, superseded=superseded))
+
+    def latest_versions(self, lc: LoggedConnection) -> pd.Series:
+        '''Get the latest update_date of each claim in our range of bene_ids.
+
+        Versions of a claim may be in different chunks of the
+        source query, so we survey just the key and update_date
+        of the whole range first.
+        '''
+        t = self.table_info(lc).tables[self.qualified_name()]
+        update_col = self.i2b2_map['update_date']
+        q = self.bene_sampled(
+            sqla.select([t.c[name] for name in self.claim_key] + [t.c[update_col]])
+            .where(t.c.bene_id.between(self.bene_id_first, self.bene_id_last)), t.c.bene_id)
+        versions = read_sql_step(q, lc)
+        with lc.log.step('%(event)s of %(versions)d claim versions',
+                         dict(event='find latest', versions=len(versions))) as step:
+            # sort=False: a hash-based max per claim; no need to sort
+            latest = versions.groupby(self.claim_key, sort=False)[update_col].max()
+            step.argobj.update(claims=len(latest))
+            step.msg_parts.append(': %(claims)d claims')
+        return latest
+
+    def pivot_chunk(self, log: EventLogger, data: pd.DataFrame, plan: 'PivotPlan',
+                    pmap: pd.DataFrame, emap: pd.DataFrame,
+                    vocab: Vocabulary) -> Iterator[pd.DataFrame]:
+        '''Pivot and map a chunk of records, one part (dx/px, other facts) at a time.
+        '''
+        # re-pivoting touches only simple columns
+        obs = None if self.repivot else self.custom_obs(log, data, plan, vocab)
+        if obs is not None:
+            yield self._mapped(log, obs, pmap, emap, vocab)
+            del obs
+
+        with log.step('%(event)s from %(records)d %(source_table)s records',
+                      dict(event='pivot facts', records=len(data),
+                           source_table=self.qualified_name())) as pivot_step:
+            obs_v = self.pivot_facts(data, plan, vocab=vocab)
+            pivot_step.argobj.update(dict(obs_len=len(obs_v)))
+            pivot_step.msg_parts.append(' %(obs_len)d observations')
+            mapped = self._mapped(log, obs_v, pmap, emap, vocab) if len(obs_v) > 0 else None
+            del obs_v
+        if mapped is not None:
+            yield mapped
+
+    def _mapped(self, log: EventLogger, obs: pd.DataFrame,
+                pmap: pd.DataFrame, emap: pd.DataFrame, vocab: Vocabulary) -> pd.DataFrame:
+        mapped = self.with_mapping(obs, pmap, emap, vocab)
+        log.info('after mapping by %s: %d',
+                 'medpar_id' if 'medpar_id' in obs.columns.values else 'bene_id and start_date',
+                 len(mapped))
+        return mapped
+
+    def _pivot_in_workers(self, lc: LoggedConnection,
+                          inputs: Iterator[Tuple[pd.DataFrame, float]],
+                          plan: 'PivotPlan', pmap: pd.DataFrame, emap: pd.DataFrame
+                          ) -> Iterator[Tuple[Iterable[pd.DataFrame], Opt[List[str]], float]]:
+        '''Pivot chunks in a pool of worker processes.
+
+        Workers get the plan and mappings once, when they start.
+        Results come back in input order, with the labels of the
+        worker's vocabulary. For backpressure, we read ahead
+        only 2 chunks per worker.
+
+        The result type is that of pivoting in this process, where
+        the parts of each chunk stream from `pivot_chunk` and the
+        labels are None (see `FactBuffer.append`).
+        '''
+        with lc.log.step('%(event)s: %(workers)d',
+                         dict(event='start pivot workers', workers=self.workers)):
+            # spawn rather than fork: don't share our DB connection
+            pool = multiprocessing.get_context('spawn').Pool(
+                self.workers, initializer=_pivot_worker_init,
+                initargs=(type(self), self.to_str_params(), plan, pmap, emap))
+        try:
+            pending = deque()  # type: Any
+            for data, pct_in in inputs:
+                pending.append((pool.apply_async(_pivot_worker, (data,)), pct_in))
+                if len(pending) >= 2 * self.workers:
+                    result, pct = pending.popleft()
+                    parts, labels = result.get()
+                    yield parts, labels, pct
+            while pending:
+                result, pct = pending.popleft()
+                parts, labels = result.get()
+                yield parts, labels, pct
+        finally:
+            pool.terminate()
 
     def _input_progress(self, data: pd.DataFrame,
                         subtot_in: int,
                         s1: LogState) -> Tuple[int, float]:
         subtot_in += len(data)
+        if subtot_in >= self.chunk_rowcount and not self.exact_rowcount:
+            # Past the estimate; expect at least one more chunk like this one.
+            self.chunk_rowcount = subtot_in + len(data)
         pct_in = 100.0 * subtot_in / self.chunk_rowcount
         s1.argobj.update(rows_in=len(data), subtot_in=subtot_in, pct_in=pct_in,
                          chunk_rowcount=self.chunk_rowcount)
@@ -994,9 +3221,10 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
 
         return out
 
-    def custom_obs(self, lc: LoggedConnection,
-                   data: pd.DataFrame, cols: pd.DataFrame) -> Tuple[Opt[pd.DataFrame], pd.DataFrame]:
-        return None, cols
+    def custom_obs(self, log: EventLogger,
+                   data: pd.DataFrame, plan: 'PivotPlan',
+                   vocab: Opt[Vocabulary]=None) -> Opt[pd.DataFrame]:
+        return None
 
     @classmethod
     def pivot_valtype(cls, valtype: Valtype, rif_data: pd.DataFrame,
@@ -1008,57 +3236,199 @@ class CMSRIFUpload(MedparMapped, CMSVariables):
         @param table_name: used with `rif_modifier` to make fact `modifier_cd`
         @param col_info: with column_name, valtype_cd columns
 
-        See also `DataFrame.melt`__.
+        See also `DataFrame.melt`__ and `pivot_facts`.
 
         __ https://pandas.pydata.org/pandas-docs/stable/generated/pandas.DataFrame.melt.html
         '''
-        id_vars = _no_dups([cls.i2b2_map[v] for v in cls.obs_id_vars if v in cls.i2b2_map])
-        ty_cols = list(col_info[col_info.valtype_cd == valtype.value].column_name)
-        ty_data = rif_data[id_vars + ty_cols].copy()
-
-        # please excuse one line of code duplication...
-        spare_digits = CMSVariables.max_cols_digits
-        ty_data['instance_num'] = ty_data.index * (10 ** spare_digits)
-
-        # i2b2 numeric (and text?) constraint searches only match modifier_cd = '@'
-        # so only use rif_modifer() on coded values.
-        ty_data['modifier_cd'] = '@'
-
-        obs = pd.melt(ty_data, id_vars=id_vars + ['instance_num', 'modifier_cd'],
-                      var_name='column').dropna(subset=['value'])
+        return cls.pivot_facts(rif_data, cls.pivot_plan(col_info), valtypes=[valtype])
 
+    @classmethod
+    def pivot_facts(cls, rif_data: pd.DataFrame, plan: 'PivotPlan',
+                    valtypes: Opt[List[Valtype]]=None,
+                    vocab: Opt[Vocabulary]=None) -> pd.DataFrame:
+        '''Unpivot columns of all (or the given) valtypes to i2b2 facts in one pass.
+
+        All-null columns are dropped before any work is done; id columns
+        are repeated by integer index rather than copied once per valtype;
+        and each fact column is allocated once for all valtypes. Facts come
+        out in the same order as calling `pivot_valtype` for each valtype in turn:
+
+        >>> rif_data, col_info, simple_cols = _RIFTestData.build(MEDPAR_Upload)
+        >>> plan = MEDPAR_Upload.pivot_plan(col_info)
+        >>> obs = MEDPAR_Upload.pivot_facts(rif_data, plan)
+        >>> obs.groupby('valtype_cd', sort=False)[['concept_cd']].count()
+        ... # doctest: +NORMALIZE_WHITESPACE
+                    concept_cd
+        valtype_cd
+        @                  155
+        T                   10
+        D                   20
+        N                  170
+
+        >>> obs.set_index(['bene_id', 'instance_num'])[
+        ...     ['valtype_cd', 'concept_cd', 'nval_num', 'tval_char']].iloc[[0, 155, 165, 185]]
+        ... # doctest: +NORMALIZE_WHITESPACE
+                               valtype_cd                concept_cd  nval_num   tval_char
+        bene_id   instance_num
+        47PZ1AN7X 0                     @        MEDPAR_YR_NUM:2012       NaN        None
+                  0                     T                PRVDR_NUM:       NaN   8086SOV68
+                  0                     D  BENE_MDCR_BNFT_EXHST_DT:       NaN  1987-04-09
+                  0                     N             BENE_AGE_CNT:      67.0           E
+
+        Given a `Vocabulary`, `concept_cd` and `modifier_cd` are encoded:
+
+        >>> vocab = Vocabulary()
+        >>> obs = MEDPAR_Upload.pivot_facts(rif_data, plan, vocab=vocab)
+        >>> obs.concept_cd.dtype, len(vocab)
+        (dtype('int32'), 194)
+        >>> list(vocab.as_categories(obs, Vocabulary.fact_columns).concept_cd[[0, 155, 185]])
+        ['MEDPAR_YR_NUM:2012', 'PRVDR_NUM:', 'BENE_AGE_CNT:']
+        '''
+        id_vars = plan.id_vars
         V = Valtype
-        obs['valtype_cd'] = valtype.value
-
-        scheme = obs.column
-        for target, replacement in cls.concept_scheme_override.items():
-            scheme = scheme.where(scheme != target, replacement)
-        scheme = scheme.str.upper() + ':'
 
-        if valtype == V.coded:
-            obs['concept_cd'] = scheme + obs.value
-            obs['tval_char'] = None  # avoid NaN, which causes sqlalchemy to choke
-        else:
-            obs['concept_cd'] = scheme
+        # Which rows of which columns have values? Skip all-null columns.
+        live = []  # type: List[Tuple[str, Valtype, str, np.ndarray]]
+        for name, valtype, scheme in plan.fact_cols:
+            if valtypes is not None and valtype not in valtypes:
+                continue
+            rows = np.flatnonzero(pd.notnull(rif_data[name].values))
+            if len(rows) > 0:
+                live.append((name, valtype, scheme, rows))
+
+        qty = sum(len(rows) for _n, _v, _s, rows in live)
+        row_ix = (np.concatenate([rows for _n, _v, _s, rows in live]) if live
+                  else np.zeros(0, dtype=int))
+        valtype_cd = np.empty(qty, dtype=object)
+        concept_cd = np.empty(qty, dtype=object if vocab is None else Vocabulary.code_dtype)
+        tval_char = np.empty(qty, dtype=object)  # None rather than NaN, which sqlalchemy chokes on
+        numbers = []  # type: List[np.ndarray]
+        nval_num = np.full(qty, np.nan)
+        dates = []  # type: List[Tuple[slice, np.ndarray]]
+
+        pos = 0
+        for name, valtype, scheme, rows in live:
+            at = slice(pos, pos + len(rows))
+            pos += len(rows)
+            value = rif_data[name].values.take(rows)
+            valtype_cd[at] = valtype.value
+            if valtype == V.coded:
+                concept_cd[at] = _prefix_codes(scheme, value, vocab)
+                continue
+            concept_cd[at] = scheme if vocab is None else vocab.intern([scheme])[0]
             if valtype == V.numeric:
-                obs['nval_num'] = obs.value
-                obs['tval_char'] = NumericOp.eq.value
+                numbers.append(value)
+                nval_num[at] = value
+                tval_char[at] = NumericOp.eq.value
             elif valtype == V.text:
-                obs['tval_char'] = obs.value
+                tval_char[at] = value
             elif valtype == V.date:
-                obs['tval_char'] = obs.value.astype('<U')  # format yyyy-mm-dd...
+                tval_char[at] = pd.Series(value).astype('<U').values  # format yyyy-mm-dd...
+                dates.append((at, value))
             else:
                 raise TypeError(valtype)
+        if numbers and len(numbers) == len(live):
+            nval_num = np.concatenate(numbers)  # keep integer dtype when we can
 
-        if valtype == V.date:
-            obs['start_date'] = obs['end_date'] = obs.value
-        else:
-            obs = cls._map_cols(obs, ['start_date', 'end_date'])
+        spare_digits = CMSVariables.max_cols_digits
+        out = pd.DataFrame({v: rif_data[v].values.take(row_ix) for v in id_vars},
+                           columns=id_vars)
+        out['instance_num'] = rif_data.index.values.take(row_ix) * (10 ** spare_digits)
+        # i2b2 numeric (and text?) constraint searches only match modifier_cd = '@'
+        # so only use rif_modifer() on coded values.
+        out['modifier_cd'] = '@' if vocab is None else vocab.intern(['@'])[0]
+        out['valtype_cd'] = valtype_cd
+        out['concept_cd'] = concept_cd
+        out['tval_char'] = tval_char
+        out['nval_num'] = nval_num
+
+        for i2b2_col in ['start_date', 'end_date']:
+            if i2b2_col in cls.i2b2_map:
+                dt = out[cls.i2b2_map[i2b2_col]].copy()
+            elif dates:
+                dt = pd.Series(None, index=out.index, dtype=object)
+            else:
+                continue
+            for at, value in dates:
+                dt.iloc[at] = value
+            out[i2b2_col] = dt
+        for i2b2_col in ['update_date', 'provider_id', 'quantity_num', 'confidence_num']:
+            if i2b2_col in cls.i2b2_map:
+                out[i2b2_col] = out[cls.i2b2_map[i2b2_col]]
+
+        return out
 
-        obs = cls._map_cols(obs, ['update_date'], required=True)
-        obs = cls._map_cols(obs, ['provider_id', 'quantity_num', 'confidence_num'])
 
-        return obs
+def drop_superseded(data: pd.DataFrame, latest: pd.Series,
+                    key: List[str], update_col: str) -> Tuple[pd.DataFrame, int]:
+    '''Keep only the latest version of each claim.
+
+    :param latest: latest `update_col` value, indexed by `key`
+    :return: current records, number of superseded records dropped
+
+    >>> data = pd.DataFrame(dict(
+    ...     clm_id=['c1', 'c1', 'c2', 'c3', 'c3', None],
+    ...     nch_wkly_proc_dt=pd.to_datetime(['2001-01-05', '2001-03-02', '2001-02-02',
+    ...                                      '2001-04-06', '2001-04-06', '2001-01-05'])))
+    >>> latest = data.groupby(['clm_id'], sort=False).nch_wkly_proc_dt.max()
+    >>> current, qty = drop_superseded(data, latest, ['clm_id'], 'nch_wkly_proc_dt')
+    >>> qty
+    2
+    >>> current
+      clm_id nch_wkly_proc_dt
+    1     c1       2001-03-02
+    2     c2       2001-02-02
+    4     c3       2001-04-06
+    5   None       2001-01-05
+
+    Records with no key are kept; of those with the same key and
+    update date, we keep the last one in the chunk.
+    '''
+    if len(key) > 1:
+        keys = pd.MultiIndex.from_arrays([data[name].values for name in key])
+    else:
+        keys = pd.Index(data[key[0]].values)
+    best = latest.reindex(keys).values
+    updated = data[update_col].values
+    keyed = data[key].notnull().all(axis=1).values
+    # compare only where both dates are known; NaT comparisons warn
+    known = ~pd.isnull(best) & ~pd.isnull(updated)
+    newer = np.zeros(len(data), dtype=bool)
+    newer[known] = updated[known] >= best[known]
+    current = ~keyed | pd.isnull(best) | newer
+    current &= ~(keyed & data[key + [update_col]].duplicated(keep='last').values)
+    return data[current], int(len(data) - current.sum())
+
+
+_worker = {}  # type: Dict[str, Any]
+
+
+def _pivot_worker_init(task_family: Type[CMSRIFUpload], str_params: Dict[str, str],
+                       plan: 'PivotPlan', pmap: pd.DataFrame, emap: pd.DataFrame) -> None:
+    task = task_family.from_str_params(str_params)
+    _worker.update(task=task, plan=plan, pmap=pmap, emap=emap,
+                   log=EventLogger(log, dict(task=task.task_id, worker=os.getpid())))
+
+
+def _pivot_worker(data: pd.DataFrame) -> Tuple[List[pd.DataFrame], List[str]]:
+    vocab = Vocabulary()  # fresh for each chunk; the parent translates codes
+    parts = list(_worker['task'].pivot_chunk(
+        _worker['log'], data, _worker['plan'], _worker['pmap'], _worker['emap'], vocab))
+    return parts, vocab.labels()
+
+
+def _prefix_codes(prefix: str, values: np.ndarray,
+                  vocab: Opt[Vocabulary]=None) -> np.ndarray:
+    '''Prefix coded values with a concept scheme, formatting each distinct value once.
+
+    >>> _prefix_codes('DRG:', np.array(['123', '45', '123'], dtype=object))
+    array(['DRG:123', 'DRG:45', 'DRG:123'], dtype=object)
+    '''
+    ixs, uniques = pd.factorize(values)
+    labels = [prefix + u for u in uniques]
+    if vocab is None:
+        return np.array(labels, dtype=object).take(ixs)
+    return vocab.intern(labels).take(ixs)
 
 
 def _no_dups(seq: List[T]) -> List[T]:
@@ -1073,41 +3443,78 @@ def _no_dups(seq: List[T]) -> List[T]:
 def obs_stack(rif_data: pd.DataFrame,
               rif_table_name: str, projections: pd.DataFrame,
               id_vars: List[str], value_vars: List[str]) -> pd.DataFrame:
-    '''
+    '''Stack groups of related columns (e.g. diagnosis code and version).
+
     :param projections: columns to project (e.g. diagnosis code and version);
                         order matches value_vars
     :param id_vars: a la pandas.melt (no dups allowed)
     :param value_vars: a la melt; data column (e.g. dgns_cd) followed by dgns_vrsn etc.
+    :return: one row per group per source record where the first two
+             value_vars are present, with id_vars, value_vars,
+             instance_num (source row * 1000 + group number),
+             mod_grp, and x columns, in group-major order
+
+    All groups are stacked at once: each of the value_vars is gathered
+    into one (groups x records) array and the present cells are picked
+    out with a single mask.
+
+    >>> rif_data = pd.DataFrame(dict(bene_id=['b1', 'b2'],
+    ...                              dgns_1_cd=['250', '401'], dgns_vrsn_cd_1=['9', '9'],
+    ...                              dgns_2_cd=[None, 'E11'], dgns_vrsn_cd_2=[None, '10']),
+    ...                         index=[7, 8])
+    >>> projections = pd.DataFrame(dict(column_name=['dgns_1_cd', 'dgns_2_cd'],
+    ...                                 column_name_vrsn=['dgns_vrsn_cd_1', 'dgns_vrsn_cd_2']),
+    ...                            index=pd.MultiIndex.from_tuples([('DGNS', 1.0), ('DGNS', 2.0)],
+    ...                                                            names=['mod_grp', 'ix']),
+    ...                            columns=['column_name_vrsn', 'column_name'])
+    >>> obs_stack(rif_data, 't', projections, ['bene_id'], ['dgns_vrsn', 'dgns_cd'])
+      bene_id dgns_vrsn dgns_cd  instance_num mod_grp    x
+    0      b1         9     250          7000    DGNS  1.0
+    1      b2         9     401          8000    DGNS  1.0
+    2      b2        10     E11          8001    DGNS  2.0
     '''
     assert id_vars == _no_dups(id_vars)
     assert len(projections) >= 1
 
     spare_digits = CMSVariables.max_cols_digits
+    qty = len(rif_data)
+
+    # value_cols is shorter than value_vars when there's no POA flag
+    groups = [list(rif_cols.dropna()) for _, rif_cols in projections.iterrows()]
+    value_vars = value_vars[:max(len(value_cols) for value_cols in groups)]
+
+    def stacked(var_ix: int) -> np.ndarray:
+        parts = [rif_data[value_cols[var_ix]].values if var_ix < len(value_cols) else None
+                 for value_cols in groups]
+        proto = next(part for part in parts if part is not None)
+        return np.concatenate([_nulls_like(proto) if part is None else part
+                               for part in parts])
+
+    values = [stacked(var_ix) for var_ix in range(len(value_vars))]
+    present = pd.notnull(values[0])
+    if len(values) > 1:
+        present &= pd.notnull(values[1])
+    pick = np.flatnonzero(present)
+    grp_ix, row_ix = pick // qty, pick % qty
+
+    out = pd.DataFrame({v: rif_data[v].values.take(row_ix) for v in id_vars},
+                       columns=id_vars)
+    for var, value in zip(value_vars, values):
+        out[var] = value.take(pick)  # e.g. icd_dgns_cd11 -> dgns_cd
+    out['instance_num'] = rif_data.index.values.take(row_ix) * (10 ** spare_digits) + grp_ix
+    out['mod_grp'] = projections.index.get_level_values(0).values.take(grp_ix)
+    out['x'] = projections.index.get_level_values(1).values.take(grp_ix)
+    return out
 
-    out = None
-    for ix, ((mod_grp, x), rif_cols) in enumerate(projections.iterrows()):
-        value_cols = list(rif_cols.dropna())
-        obs = rif_data[id_vars + value_cols].copy()
-
-        instance_num = obs.index * (10 ** spare_digits) + ix
-        obs = obs.set_index(id_vars)
-        # value_cols is shorter than value_vars when there's no POA flag
-        obs.columns = value_vars[:len(value_cols)]  # e.g. icd_dgns_cd11 -> dgns_cd
-        obs['instance_num'] = instance_num
-
-        obs = obs.dropna(subset=value_vars[:2])
-        obs['mod_grp'] = mod_grp
-        obs['x'] = x
-
-        if out is None:
-            out = obs
-        else:
-            out = out.append(obs)
-
-    if out is None:
-        raise TypeError('no projections?')
 
-    return out
+def _nulls_like(proto: np.ndarray) -> np.ndarray:
+    '''All-null array of the same shape and (null-capable) type as proto.
+    '''
+    if proto.dtype.kind in 'mM':
+        return np.full(proto.shape, np.datetime64('NaT'), dtype=proto.dtype)
+    if proto.dtype.kind == 'f':
+        return np.full(proto.shape, np.nan, dtype=proto.dtype)
+    return np.full(proto.shape, np.nan, dtype=object)
 
 
 class date_trunc(sqla.sql.functions.GenericFunction):  # type: ignore
@@ -1116,7 +3523,39 @@ class date_trunc(sqla.sql.functions.GenericFunction):  # type: ignore
 
 
 class _ByExtractYear(CMSRIFUpload):
+    """Annual summaries, by beneficiary.
+
+    Monthly indicators (buy-in, HMO, eligibility, ...) are loaded as
+    spans of months with the same value rather than 12 facts per
+    bene-year; for example, a beneficiary in an HMO from March
+    thru October:
+
+    >>> data = pd.DataFrame(dict(
+    ...     [('bene_id', ['b1', 'b2']),
+    ...      ('start_date', pd.to_datetime(['2013-01-01', '2013-01-01'])),
+    ...      ('extract_dt', pd.to_datetime(['2013-12-31', '2013-12-31'])),
+    ...      ('download_date', pd.to_datetime(['2017-01-01', '2017-01-01']))] +
+    ...     [('bene_hmo_ind_%02d' % m, ['C' if 3 <= m <= 10 else '0', '0']) for m in range(1, 13)] +
+    ...     [('bene_mdcr_entlmt_buyin_ind_%02d' % m, ['3' if m < 6 else 'C', None])
+    ...      for m in range(1, 13)]),
+    ...     index=pd.Index([10, 11], name='src_ix'))
+    >>> obs = MBSFUpload.span_facts(data)
+    >>> obs[['bene_id', 'instance_num', 'concept_cd', 'start_date', 'end_date']]
+    ... # doctest: +NORMALIZE_WHITESPACE
+      bene_id  instance_num                   concept_cd start_date   end_date
+    0      b1         10001  BENE_MDCR_ENTLMT_BUYIN_IND:3 2013-01-01 2013-05-31
+    1      b1         10006  BENE_MDCR_ENTLMT_BUYIN_IND:C 2013-06-01 2013-12-31
+    2      b1         10015               BENE_HMO_IND:C 2013-03-01 2013-10-31
+
+    The first of `monthly_cols` determines PCORnet ENROLLMENT:
+
+    >>> MBSFUpload.enrollment(data)
+      bene_id ENR_START_DATE ENR_END_DATE CHART ENR_BASIS
+    0      b1     2013-01-01   2013-12-31     Y         I
+    """
     bene_enrollmt_ref_yr = IntParam(default=2013)
+    # load monthly_cols as spans
+    enrollment_spans = BoolParam(default=False, significant=False)
 
     i2b2_map = dict(
         patient_ide='bene_id',
@@ -1124,18 +3563,130 @@ class _ByExtractYear(CMSRIFUpload):
         end_date='extract_dt',    # end of year
         update_date='download_date')
 
+    # (concept scheme, column name pattern, values that mean "not enrolled")
+    monthly_cols = []  # type: List[Tuple[str, str, List[str]]]
+
     def source_query(self, meta: sqla.MetaData) -> sqla.sql.expression.Select:
         t = meta.tables[self.qualified_name()].alias('rif')
         download_col = sqla.literal(self.source.download_date).label('download_date')
         start_date = date_trunc(t.c.extract_dt, 'year').label('start_date')
-        return (sqla.select([self.src_ix, start_date, t.c.extract_dt, download_col] +  # type: ignore
-                            self.active_source_cols(t))
-                .where(t.c.bene_id.between(self.bene_id_first, self.bene_id_last)))
+        month_cols = ([t.c[name] for cols in self.month_col_groups() for name in cols[1]]
+                      if self.enrollment_spans and not self.repivot else [])
+        return self.numbered(self.bene_sampled(
+            sqla.select([start_date, t.c.extract_dt, download_col] +
+                        self.source_cols(t) + month_cols)
+            .where(t.c.bene_id.between(self.bene_id_first, self.bene_id_last)), t.c.bene_id), t)
+
+    @classmethod
+    def month_col_groups(cls) -> List[Tuple[str, List[str], List[str]]]:
+        return [(scheme, [pattern % month for month in range(1, 13)], off)
+                for scheme, pattern, off in cls.monthly_cols]
+
+    @classmethod
+    def compile_plan(cls, cols: pd.DataFrame) -> PivotPlan:
+        monthly = [name for _s, names, _o in cls.month_col_groups() for name in names]
+        return PivotPlan(cls.mapped_id_vars(), cols[~cols.column_name.isin(monthly)],
+                         cls.concept_scheme_override)
+
+    def custom_obs(self, log: EventLogger,
+                   data: pd.DataFrame, plan: PivotPlan,
+                   vocab: Opt[Vocabulary]=None) -> Opt[pd.DataFrame]:
+        if not self.enrollment_spans:
+            return None
+        with log.step('%(event)s from %(records)d %(source_table)s records',
+                      dict(event='monthly spans', records=len(data),
+                           source_table=self.qualified_name())) as step:
+            obs = self.span_facts(data, vocab)
+            # None: this chunk has none of the monthly columns
+            step.argobj.update(dict(span_qty=0 if obs is None else len(obs)))
+            step.msg_parts.append(' %(span_qty)d spans')
+        return obs
+
+    @classmethod
+    def span_facts(cls, data: pd.DataFrame, vocab: Opt[Vocabulary]=None) -> Opt[pd.DataFrame]:
+        '''Facts for spans of months with the same value, in one pass per group of columns.
+        '''
+        parts = []
+        for grp_ix, (scheme, names, off) in enumerate(cls.month_col_groups()):
+            if not all(name in data.columns.values for name in names):
+                continue
+            values = data[names].values
+            row, first, last, value = month_spans(values)
+            keep = np.flatnonzero(pd.notnull(value) & ~pd.Series(value).isin(off).values)
+            row, first, last, value = row[keep], first[keep], last[keep], value[keep]
+            out = pd.DataFrame({v: data[v].values.take(row) for v in cls.mapped_id_vars()},
+                               columns=cls.mapped_id_vars())
+            # low digits: 1 + month + 12 * group; pivot_facts uses 0
+            out['instance_num'] = (data.index.values.take(row) * (10 ** CMSVariables.max_cols_digits) +
+                                   1 + first + 12 * grp_ix)
+            out['valtype_cd'] = Valtype.coded.value
+            out['concept_cd'] = _prefix_codes(scheme.upper() + ':', value, vocab)
+            out['modifier_cd'] = '@' if vocab is None else vocab.intern(['@'])[0]
+            out['start_date'], out['end_date'] = _month_range(data.start_date.values.take(row), first, last)
+            out['update_date'] = out[cls.i2b2_map['update_date']]
+            parts.append(out)
+        if not parts:
+            return None
+        return pd.concat(parts, ignore_index=True)
+
+    @classmethod
+    def enrollment(cls, data: pd.DataFrame) -> pd.DataFrame:
+        '''PCORnet ENROLLMENT spans (by bene_id rather than PATID)
+        from the first of `monthly_cols`.
+
+        Months with any value other than null or "not enrolled" count.
+        '''
+        _scheme, names, off = cls.month_col_groups()[0]
+        months = data[names]
+        enrolled = (months.notnull() & ~months.isin(off)).values
+        row, first, last, value = month_spans(enrolled)
+        keep = np.flatnonzero(value.astype(bool))
+        row, first, last = row[keep], first[keep], last[keep]
+        start, end = _month_range(data.start_date.values.take(row), first, last)
+        return pd.DataFrame(dict(bene_id=data.bene_id.values.take(row),
+                                 ENR_START_DATE=start, ENR_END_DATE=end,
+                                 CHART='Y', ENR_BASIS='I'),
+                            columns=['bene_id', 'ENR_START_DATE', 'ENR_END_DATE', 'CHART', 'ENR_BASIS'])
+
+
+def month_spans(months: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''Run-length encode monthly values: one row per record, one column per month.
+
+    :return: row, first month, last month, and value of each span
+             (months counting from 0)
+
+    >>> row, first, last, value = month_spans(np.array([
+    ...     ['A', 'A', 'B', 'B', 'B', None],
+    ...     ['B', 'B', 'B', 'B', 'B', 'B']], dtype=object))
+    >>> list(row), list(first), list(last), list(value)
+    ([0, 0, 0, 1], [0, 2, 5, 0], [1, 4, 5, 5], ['A', 'B', None, 'B'])
+    '''
+    qty, width = months.shape
+    # A span starts in the first month or where the value changes.
+    change = np.ones(months.shape, dtype=bool)
+    change[:, 1:] = months[:, 1:] != months[:, :-1]
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], qty * width) - 1
+    return starts // width, starts % width, ends % width, months.ravel().take(starts)
+
+
+def _month_range(year_start: np.ndarray, first: np.ndarray, last: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''First day of first month and last day of last month after year_start.
+    '''
+    start_month = year_start.astype('datetime64[M]')
+    start = (start_month + first).astype('datetime64[D]')
+    end = (start_month + last + 1).astype('datetime64[D]') - np.timedelta64(1, 'D')
+    return start.astype('datetime64[ns]'), end.astype('datetime64[ns]')
 
 
 class MBSFUpload(_ByExtractYear):
     table_name = 'mbsf_ab_summary'
 
+    monthly_cols = [
+        ('bene_mdcr_entlmt_buyin_ind', 'bene_mdcr_entlmt_buyin_ind_%02d', ['0']),
+        ('bene_hmo_ind', 'bene_hmo_ind_%02d', ['0']),
+    ]
+
 
 class MAXPSUpload(_ByExtractYear):
     '''
@@ -1153,6 +3704,10 @@ class MAXPSUpload(_ByExtractYear):
     '''
     table_name = 'maxdata_ps'
 
+    monthly_cols = [
+        ('max_elg_cd_mo', 'max_elg_cd_mo_%d', ['00']),
+    ]
+
     valtype_override = [
         ('@', '.*_cd$')  # e.g. EL_AGE_GRP_CD
     ]
@@ -1202,28 +3757,33 @@ class _DxPxCombine(CMSRIFUpload):
             groups = pd.merge(groups, dt_cols, on=ix_cols, how='left', suffixes=['', suffixes[2]])
         return groups.set_index(ix_cols)
 
-    def custom_obs(self, lc: LoggedConnection,
-                   data: pd.DataFrame, cols: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    @classmethod
+    def compile_plan(cls, cols: pd.DataFrame) -> PivotPlan:
         # curated column info
-        col_info = self.active_col_data()
+        col_info = cls.active_col_data()
         # order col_info like db cols
         col_info = col_info.set_index('column_name').loc[cols.column_name].reset_index()
-        dx_g = self.vrsn_cd_groups(col_info, kind='DGNS', aux='DGNS_IND')
-        px_g = self.vrsn_cd_groups(col_info, kind='PRCDR', aux='PRCDR_DT')
-        simple_cols = cols[(~col_info.Status.isnull()) &
-                           ~cols.column_name.isin(self.i2b2_map.values()) &
-                           col_info.dxpx.isnull()]
-
-        with lc.log.step('%(event)s from %(records)d %(source_table)s records',
-                         dict(event='stack dx, px', records=len(data),
-                              source_table=self.qualified_name())) as stack_step:
+        dx_g = cls.vrsn_cd_groups(col_info, kind='DGNS', aux='DGNS_IND')
+        px_g = cls.vrsn_cd_groups(col_info, kind='PRCDR', aux='PRCDR_DT')
+        simple_cols = cols[(~col_info.Status.isnull()).values &
+                           ~cols.column_name.isin(cls.i2b2_map.values()).values &
+                           col_info.dxpx.isnull().values]
+        return PivotPlan(cls.mapped_id_vars(), simple_cols, cls.concept_scheme_override,
+                         dx_groups=dx_g, px_groups=px_g)
+
+    def custom_obs(self, log: EventLogger,
+                   data: pd.DataFrame, plan: PivotPlan,
+                   vocab: Opt[Vocabulary]=None) -> Opt[pd.DataFrame]:
+        with log.step('%(event)s from %(records)d %(source_table)s records',
+                      dict(event='stack dx, px', records=len(data),
+                           source_table=self.qualified_name())) as stack_step:
             obs = None
-            obs_dx = self.dx_data(data, self.table_name, dx_g)
+            obs_dx = self.dx_data(data, self.table_name, plan.dx_groups, vocab=vocab)
             if obs_dx is not None:
                 stack_step.msg_parts.append(' %(dx_len)d diagnoses')
                 stack_step.argobj.update(dict(dx_len=len(obs_dx)))
                 obs = obs_dx
-            obs_px = self.px_data(data, self.table_name, px_g)
+            obs_px = self.px_data(data, self.table_name, plan.px_groups, vocab=vocab)
             if obs_px is not None:
                 stack_step.msg_parts.append(' %(px_len)d procedures')
                 stack_step.argobj.update(dict(px_len=len(obs_px)))
@@ -1231,16 +3791,17 @@ class _DxPxCombine(CMSRIFUpload):
                     obs = obs_px
                 else:
                     obs = obs.append(obs_px)
-        return obs, simple_cols
+        return obs
 
     @classmethod
     def dx_data(cls, rif_data: pd.DataFrame,
                 table_name: str, dx_cols: pd.DataFrame,
-                log: logging.Logger=log,
-                vrsn_default: str='9') -> pd.DataFrame:
+                vrsn_default: str='9',
+                vocab: Opt[Vocabulary]=None) -> pd.DataFrame:
         """Combine diagnosis columns i2b2 style
 
         :param vrsn_default: for MAXDATA_IP, default to IDC9
+        :param vocab: to encode `concept_cd` and `modifier_cd`
         """
         if len(dx_cols) < 1:
             return None
@@ -1255,35 +3816,43 @@ class _DxPxCombine(CMSRIFUpload):
 
         obs = obs_stack(rif_data, table_name, dx_cols,
                         id_vars=id_vars,
-                        value_vars=value_vars).reset_index()
+                        value_vars=value_vars)
         obs['valtype_cd'] = Valtype.coded.value
 
         if 'dgns_vrsn' not in obs.columns:
             obs['dgns_vrsn'] = vrsn_default
 
-        obs['concept_cd'] = fmt_dx_codes(obs.dgns_vrsn, obs.dgns_cd)
+        obs['concept_cd'] = dx_code_format(obs.dgns_vrsn, obs.dgns_cd, vocab=vocab)
 
         # We don't need this after all, do we?
         # poa_suffix = np.where(obs.dgns_poa_ind.isnull() | (obs.dgns_poa_ind == ' '),
         #                       '', '+POA:' + obs.dgns_poa_ind)
-        pdx_suffix = np.where(obs.x == 1, '+PDX', '')
-        obs['modifier_cd'] = 'DX:' + obs.mod_grp + pdx_suffix
+        grp_ixs, grps = pd.factorize(obs.mod_grp)
+        modifiers = ['DX:' + grp + pdx_suffix for pdx_suffix in ['', '+PDX'] for grp in grps]
+        pdx_ixs = np.where(obs.x == 1, len(grps), 0) + grp_ixs
+        if vocab is None:
+            obs['modifier_cd'] = np.array(modifiers, dtype=object).take(pdx_ixs)
+        else:
+            obs['modifier_cd'] = vocab.intern(modifiers).take(pdx_ixs)
 
         obs = cls._map_cols(obs, cls.obs_value_cols, required=True)
         obs = cls._map_cols(obs, ['provider_id'])
 
-        return _check_start_date(obs, threshold=(0.01, log))
+        # null start_date etc. are checked along with all the other facts
+        # in FactBuffer.validate
+        return obs
 
     @classmethod
     def px_data(cls, data: pd.DataFrame, table_name: str, px_cols: pd.DataFrame,
-                log: logging.Logger=log,
                 default_vrsn: str='HCPCS', exclude_vrsn: List[str]=['88', '99'],
                 px_source_mod: str='PX_SOURCE:CL',
-                obs_value_cols: List[str]=['provider_id', 'update_date']) -> pd.DataFrame:
+                obs_value_cols: List[str]=['provider_id', 'update_date'],
+                vocab: Opt[Vocabulary]=None) -> pd.DataFrame:
         """Combine procedure columns i2b2 style
 
-        Forward-fill `start_date` because MAXDATA_IP has may procedure
-        code columns but only one procedure date column.
+        Forward-fill `start_date` (within each source record) because
+        MAXDATA_IP has may procedure code columns but only one procedure
+        date column.
 
         :param exclude_vrsn: indication that there was no procedure observed
         """
@@ -1299,17 +3868,22 @@ class _DxPxCombine(CMSRIFUpload):
         obs = obs_stack(data, table_name, px_cols,
                         id_vars=_no_dups([cls.i2b2_map[v]
                                           for v in cls.obs_id_vars if v in cls.i2b2_map]),
-                        value_vars=value_vars).reset_index()
+                        value_vars=value_vars)
         obs['valtype_cd'] = Valtype.coded.value
         obs['modifier_cd'] = px_source_mod
         if 'prcdr_vrsn' not in obs.columns:
             obs['prcdr_vrsn'] = default_vrsn
         obs = obs[~obs.prcdr_vrsn.isin(exclude_vrsn)]
-        obs['concept_cd'] = fmt_px_codes(obs.prcdr_cd, obs.prcdr_vrsn)
+        obs['concept_cd'] = px_code_format(obs.prcdr_vrsn, obs.prcdr_cd, vocab=vocab)
+        if vocab is not None:
+            obs['modifier_cd'] = vocab.intern([px_source_mod])[0]
 
         if 'prcdr_dt' in obs.columns:
-            obs = obs.rename(columns=dict(prcdr_dt='start_date')).sort_values('instance_num')
-            obs.start_date.fillna(method='ffill', inplace=True)
+            obs = obs.rename(columns=dict(prcdr_dt='start_date'))
+            # obs_stack output is group-major, so within each source record,
+            # facts are already in procedure order; no need to sort.
+            src_row = obs.instance_num.values // (10 ** CMSVariables.max_cols_digits)
+            obs['start_date'] = obs.start_date.groupby(src_row).ffill()
         else:
             obs['start_date'] = np.nan
         if 'start_date' in cls.i2b2_map:
@@ -1319,7 +3893,7 @@ class _DxPxCombine(CMSRIFUpload):
 
         obs = cls._map_cols(obs, obs_value_cols)
 
-        return _check_start_date(obs, threshold=(0.01, log))
+        return obs
 
 
 class MEDPAR_Upload(_DxPxCombine):
@@ -1342,30 +3916,13 @@ class MEDPAR_Upload(_DxPxCombine):
         end_date='dschrg_dt',
         provider_id='org_npi_num',
         update_date='ltst_clm_acrtn_dt')
+    claim_key = ['medpar_id']
 
     # MSDRG per PCORNET_ENC metadata
     concept_scheme_override = dict(_DxPxCombine.concept_scheme_override,
                                    drg_cd='MSDRG')
 
 
-def _check_start_date(obs: pd.DataFrame,
-                      threshold: Opt[Tuple[float, logging.Logger]]=None) -> pd.DataFrame:
-    tot = len(obs)
-    if tot:
-        bad = obs[obs.start_date.isnull()]
-        if len(bad) > 0:
-            if threshold is None:
-                raise ValueError(bad.head())
-            val, log = threshold
-            if len(bad) * 1.0 / tot > val:
-                raise ValueError(bad.head())
-            else:
-                log.warn('ignoring %d (%f%%) records with null start_date',
-                         len(bad), 100.0 * len(bad) / tot)
-            obs = obs[~obs.start_date.isnull()]
-    return obs
-
-
 class MAXDATA_IP_Upload(_DxPxCombine):
     table_name = 'maxdata_ip'
 
@@ -1392,6 +3949,23 @@ class CarrierClaimUpload(_DxPxCombine):
         start_date='clm_from_dt',
         end_date='clm_thru_dt',
         update_date='nch_wkly_proc_dt')
+    claim_key = ['clm_id']
+
+    def _input_chunks(self, lc: LoggedConnection, upload_id: int,
+                      chunks: Iterator[pd.DataFrame],
+                      sizer: Opt['ChunkSizer']=None,
+                      latest: Opt[pd.Series]=None) -> Iterator[Tuple[pd.DataFrame, float]]:
+        # We read every claim's clm_from_dt anyway; save
+        # CarrierLineUpload for the same bene_ids the trouble.
+        parts = []  # type: List[Tuple[np.ndarray, np.ndarray]]
+        for data, pct_in in CMSRIFUpload._input_chunks(self, lc, upload_id, chunks, sizer, latest):
+            if latest is None:
+                parts.append((ClaimDates.compact_ids(data.clm_id.values), data.clm_from_dt.values))
+            yield data, pct_in
+        if latest is None:
+            ClaimDates.share((self.qualified_name(), self.bene_id_first, self.bene_id_last,
+                              self.bene_sample_pct),
+                             ClaimDates(parts))
 
 
 class CarrierLineUpload(_DxPxCombine):
@@ -1400,6 +3974,7 @@ class CarrierLineUpload(_DxPxCombine):
     Especially procedures:
 
     >>> rif_data, col_info, simple_cols = _RIFTestData.build(CarrierLineUpload)
+    >>> rif_data['clm_from_dt'] = rif_data.clm_thru_dt  # see claim_dates
     >>> px_cols = CarrierLineUpload.vrsn_cd_groups(col_info, kind='PRCDR', aux='PRCDR_DT')
     >>> px_cols
     ... # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
@@ -1421,12 +3996,14 @@ class CarrierLineUpload(_DxPxCombine):
     '''
     table_name = 'bcarrier_line'
     claim_table_name = CarrierClaimUpload.table_name
+    # get start_date from bcarrier_claims (else use clm_thru_dt)
+    join_claim_dates = BoolParam(default=False, significant=False)
 
     i2b2_map = dict(
         patient_ide='bene_id',
-        # performance of joining with bcarrier_claims is disastrous
-        # start_date='clm_from_dt',
-        start_date='clm_thru_dt',
+        # performance of joining with bcarrier_claims is disastrous,
+        # so we join in the client; see claim_dates
+        start_date='clm_from_dt',
         end_date='clm_thru_dt',
         # ISSUE: carrier line start/end date columns?
         # start_date='line_1st_expns_dt',
@@ -1440,6 +4017,43 @@ class CarrierLineUpload(_DxPxCombine):
     concept_scheme_override = dict(_DxPxCombine.concept_scheme_override,
                                    line_ndc_cd='NDC')
 
+    def _input_chunks(self, lc: LoggedConnection, upload_id: int,
+                      chunks: Iterator[pd.DataFrame],
+                      sizer: Opt['ChunkSizer']=None,
+                      latest: Opt[pd.Series]=None) -> Iterator[Tuple[pd.DataFrame, float]]:
+        claim_dates = self.claim_dates(lc) if self.join_claim_dates else None
+        for data, pct_in in CMSRIFUpload._input_chunks(self, lc, upload_id, chunks, sizer, latest):
+            if claim_dates is None:
+                data['clm_from_dt'] = data.clm_thru_dt
+            else:
+                data['clm_from_dt'] = claim_dates.lookup(data.clm_id.values,
+                                                         default=data.clm_thru_dt.values)
+            yield data, pct_in
+
+    def claim_dates(self, lc: LoggedConnection) -> 'ClaimDates':
+        '''Get clm_from_dt of bcarrier_claims for our bene_ids, streaming
+        (clm_id, clm_from_dt) from the DB unless CarrierClaimUpload
+        already did the work for the same bene_ids.
+        '''
+        key = (self.qualified_name(self.claim_table_name), self.bene_id_first, self.bene_id_last,
+               self.bene_sample_pct)
+        with lc.log.step('%(event)s from %(claim_table)s',
+                         dict(event='claim dates', claim_table=key[0])) as step:
+            dates = _claim_dates.get(key)
+            if dates is None:
+                claim = self.source.table_details(lc, [self.claim_table_name]).tables[key[0]]
+                q = self.bene_sampled(
+                    sqla.select([claim.c.clm_id, claim.c.clm_from_dt])
+                    .where(claim.c.bene_id.between(self.bene_id_first, self.bene_id_last)), claim.c.bene_id)
+                dates = ClaimDates([(ClaimDates.compact_ids(chunk.clm_id.values), chunk.clm_from_dt.values)
+                                    for chunk in pd.read_sql(q, lc._conn, chunksize=self.chunk_size * 10)])
+                step.msg_parts.append(' (selected)')
+            else:
+                step.msg_parts.append(' (shared)')
+            step.argobj.update(claim_qty=len(dates))
+            step.msg_parts.append(': %(claim_qty)d claims')
+        return dates
+
     def _table_info_too_slow(self, lc: LoggedConnection) -> sqla.MetaData:
         return self.source.table_details(lc, [self.table_name, self.claim_table_name])
 
@@ -1461,6 +4075,7 @@ class OutpatientClaimUpload(_DxPxCombine):
         end_date='clm_thru_dt',
         update_date='nch_wkly_proc_dt',
         provider_id='at_physn_npi')
+    claim_key = ['clm_id']
 
 
 class OutpatientRevenueUpload(_DxPxCombine):
@@ -1553,9 +4168,13 @@ class MAXRxUpload(CMSRIFUpload):
 
 class _BeneIdGrouped(luigi.WrapperTask):
     group_tasks = cast(List[Type[CMSRIFUpload]], [])  # abstract
+    # see BeneMapped.bene_sample_pct
+    bene_sample_pct = IntParam(default=100, significant=False)
 
     def requires(self) -> List[luigi.Task]:
         deps = []  # type: List[luigi.Task]
+        # leave bene_sample_pct to group_task config unless we're sampling
+        sample = dict(bene_sample_pct=self.bene_sample_pct) if self.bene_sample_pct < 100 else {}
         for group_task in self.group_tasks:
             survey = BeneIdSurvey()
             deps += [survey]
@@ -1567,7 +4186,8 @@ class _BeneIdGrouped(luigi.WrapperTask):
                         group_qty=len(results),
                         bene_id_qty=ntile.bene_id_qty,
                         bene_id_first=ntile.bene_id_first,
-                        bene_id_last=ntile.bene_id_last)
+                        bene_id_last=ntile.bene_id_last,
+                        **sample)
                     for ntile in results
                 ]
         return deps
@@ -1668,6 +4288,10 @@ class VisitDimForPatGroup(_LoadTask):
     pat_group_num = IntParam(significant=False)
     chunk_size = IntParam(100000, significant=False)
     parallel_degree = IntParam(default=20, significant=False)
+    pipeline = BoolParam(default=False, significant=False)
+    # merge visit rows saved while loading facts (see DataLoadTask.visit_table)
+    # rather than scanning observation_fact via the view
+    visit_rows = StrParam(default='', significant=False)
 
     # Only one task should insert into visit_dimension at a time.
     resources = {'visit_dimension': 1}
@@ -1682,8 +4306,8 @@ class VisitDimForPatGroup(_LoadTask):
                                             self.patient_num_lo, self.patient_num_hi)
 
     def requires(self) -> List[luigi.Task]:
-        return [
-            VisitCodesCache(),
+        deps = [] if self.visit_rows else [VisitCodesCache()]  # type: List[luigi.Task]
+        return deps + [
             SqlScriptTask(script=self.prep_script,
                           param_vars=self.vars_for_deps),
         ]
@@ -1693,9 +4317,13 @@ class VisitDimForPatGroup(_LoadTask):
         dtype = {c.name: c.type for c in vdim.columns
                  if not c.name.endswith('_blob')}
 
-        q = 'select /*+ parallel({parallel_degree}) */ * from {view} where patient_num between :lo and :hi'.format(
-            parallel_degree=self.parallel_degree, view=self.view)
         pat_range = dict(lo=self.patient_num_lo, hi=self.patient_num_hi)  # type: Params
+        if self.visit_rows:
+            q = 'select * from {table} where patient_num between :lo and :hi and {latest}'.format(
+                table=self.visit_rows, latest=latest_uploads(upload.table))
+        else:
+            q = 'select /*+ parallel({parallel_degree}) */ * from {view} where patient_num between :lo and :hi'.format(
+                parallel_degree=self.parallel_degree, view=self.view)
         log_plan(lc, event=self.view, sql=q,
                  params=pat_range)
 
@@ -1704,26 +4332,74 @@ class VisitDimForPatGroup(_LoadTask):
             i2b2_star=vdim.schema, dim_table=vdim.name), params=pat_range)
         lc.execute('commit')
 
-        chunks = pd.read_sql(q, lc._conn, params=pat_range, chunksize=self.chunk_size)
+        def write(visit_chunk: pd.DataFrame, writing: LoggedConnection) -> None:
+            with writing.log.step('%(event)s %(rowcount)d rows',
+                                  dict(event='insert visits', rowcount=len(visit_chunk))):
+                visit_chunk.to_sql(schema=vdim.schema, name=vdim.name,
+                                   con=writing._conn,
+                                   dtype=dtype,
+                                   if_exists='append', index=False)
+                writing.execute('commit')
+
+        if self.visit_rows:
+            chunks = self.merged_visits(read_sql_step(q, lc, pat_range),
+                                        active=lc.scalar('select active from i2b2_status'))
+        else:
+            chunks = pd.read_sql(q, lc._conn, params=pat_range, chunksize=self.chunk_size)
+        if self.pipeline:
+            chunks = read_ahead(lc.log, chunks, 'select from ' + self.view)
         subtot = 0
-        while 1:
-            with lc.log.step('UP#%(upload_id)d: %(event)s x%(chunk_size)d into %(i2b2_star)s.%(dim_table)s',
-                             dict(event='visit chunk', chunk_size=self.chunk_size,
-                                  upload_id=upload_id, i2b2_star=vdim.schema, dim_table=vdim.name)) as step:
-                try:
-                    visit_chunk = next(chunks)
-                except StopIteration:
-                    break
-                visit_chunk = self.with_admin(visit_chunk, upload_id, lc, vdim)
-                with self.connection('insert visits') as writing:
-                    visit_chunk.to_sql(schema=vdim.schema, name=vdim.name,
-                                       con=writing._conn,
-                                       dtype=dtype,
-                                       if_exists='append', index=False)
-                    writing.execute('commit')
-                subtot += len(visit_chunk)
-                step.msg_parts.append(' %(row_subtot)s rows')
-                step.argobj.update(dict(row_subtot=subtot))
+        with write_stage(self, self.pipeline, 'insert visits') as submit:
+            while 1:
+                with lc.log.step('UP#%(upload_id)d: %(event)s x%(chunk_size)d into %(i2b2_star)s.%(dim_table)s',
+                                 dict(event='visit chunk', chunk_size=self.chunk_size,
+                                      upload_id=upload_id, i2b2_star=vdim.schema, dim_table=vdim.name)) as step:
+                    try:
+                        visit_chunk = next(chunks)
+                    except StopIteration:
+                        break
+                    visit_chunk = self.with_admin(visit_chunk, upload_id, lc, vdim)
+                    submit(partial(write, visit_chunk))
+                    subtot += len(visit_chunk)
+                    step.msg_parts.append(' %(row_subtot)s rows')
+                    step.argobj.update(dict(row_subtot=subtot))
+
+    def merged_visits(self, rows: pd.DataFrame, active: str) -> Iterator[pd.DataFrame]:
+        '''Merge visit rows from all uploads and lay them out as in
+        the `cms_visit_dimension` view, a chunk at a time.
+        '''
+        visits = best_visits(rows)
+        for lo in range(0, len(visits), self.chunk_size):
+            yield self.visit_layout(visits[lo:lo + self.chunk_size], active)
+
+    @classmethod
+    def visit_layout(cls, visits: pd.DataFrame, active: str) -> pd.DataFrame:
+        '''
+        >>> visits = pd.DataFrame(dict(
+        ...     encounter_num=[10, 20], patient_num=[1, 2], enc_type=['IP', 'AV'],
+        ...     ip_bit=[1, 0], ed_bit=[2, 0], provider_id=['@', '@'],
+        ...     start_date=pd.to_datetime(['2012-01-02', '2012-02-01']),
+        ...     end_date=pd.to_datetime(['2012-01-05', None])))
+        >>> VisitDimForPatGroup.visit_layout(visits, 'A')[
+        ...     ['encounter_num', 'inout_cd', 'start_date', 'end_date', 'length_of_stay']]
+           encounter_num inout_cd start_date   end_date  length_of_stay
+        0             10       EI 2012-01-02 2012-01-05             4.0
+        1             20       AV 2012-02-01 2012-02-01             NaN
+        '''
+        end_date = visits.end_date.fillna(visits.start_date)  # ISSUE: imputed end date
+        return pd.DataFrame(dict(
+            encounter_num=visits.encounter_num.values,
+            patient_num=visits.patient_num.values,
+            active_status_cd=active,
+            start_date=visits.start_date.values,
+            end_date=end_date.values,
+            inout_cd=np.where((visits.ed_bit.values > 0) & (visits.ip_bit.values > 0),
+                              'EI', visits.enc_type.values),
+            length_of_stay=((visits.end_date - visits.start_date).dt.days + 1).values,
+            update_date=end_date.values,
+            providerid=visits.provider_id.values),
+            columns=['encounter_num', 'patient_num', 'active_status_cd', 'start_date', 'end_date',
+                     'inout_cd', 'length_of_stay', 'update_date', 'providerid'])
 
 
 class VisitCodesCache(_LoadTask):
@@ -1765,12 +4441,56 @@ class VisitCodesCache(_LoadTask):
                                      parallel_degree=self.parallel_degree))
 
 
+def latest_uploads(up_t: sqla.Table) -> str:
+    '''Constrain upload_id to the latest complete upload of each task.
+
+    Uploads are keyed by label (task family and bene_id group; see
+    CMSRIFUpload.label) rather than transform_name, which varies with
+    design_version: a re-load at a new design_version supersedes the
+    old one rather than adding to it.
+    '''
+    return ('''upload_id in (
+          select max(upload_id) from {upload_status}
+          where load_status = 'OK'
+          group by upload_label)'''.format(upload_status='%s.%s' % (up_t.schema, up_t.name)))
+
+
+class FactSummaries(_LoadTask):
+    '''Combine per-upload fact statistics (see DataLoadTask.summary_table)
+    of the latest complete upload of each task.
+    '''
+    table = StrParam(default='upload_fact_summary')
+    summary = StrParam(default='fact_summary')
+
+    @property
+    def label(self) -> str:
+        return 'combine %s into %s' % (self.table, self.summary)
+
+    @property
+    def input_label(self) -> str:
+        return self.table
+
+    def requires(self) -> List[luigi.Task]:
+        return [self.project]
+
+    def load(self, lc: LoggedConnection, upload: 'UploadTarget', upload_id: int, result: Params) -> None:
+        per_upload = read_sql_step('select * from {table} where {latest}'.format(
+            table=self.table, latest=latest_uploads(upload.table)), lc)
+        combined = combine_summaries(per_upload, FactSummary.key)
+        with lc.log.step('%(event)s %(group_qty)d groups from %(row_qty)d rows into %(into)s',
+                         dict(event='save summary', group_qty=len(combined),
+                              row_qty=len(per_upload), into=self.summary)):
+            combined.to_sql(self.summary, lc._conn, if_exists='replace', index=False,
+                            dtype=obj_string(combined))
+        result[upload.table.c.loaded_record.name] = len(combined)
+
+
 class _RIFTestData(object):
     @classmethod
     def build(cls, task_family: Type[CMSRIFUpload], qty: int=5) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
         col_info = task_family.active_col_data()
         rng = Random(1)
-        rif_data = _RIFTestData.arb_records(5, rng, col_info)
+        rif_data = _RIFTestData.arb_records(qty, rng, col_info)
         simple_cols = col_info[~col_info.Status.isnull() &
                                ~col_info.column_name.isin(task_family.i2b2_map.values()) &
                                col_info.dxpx.isnull()]
@@ -284,7 +284,7 @@ with the_medpar as
   join the_medpar
   on the_medpar.medpar_id = emap.medpar_id
   )
-select coalesce(the_emap.encounter_num, - abs(ora_hash(fmt_patient_day(the_bene_id, obs_date))))
+select coalesce(the_emap.encounter_num, patient_day_hash(the_bene_id, obs_date))
 into the_encounter_num
 from the_emap;
 return the_encounter_num;